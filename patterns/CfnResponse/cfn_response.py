@@ -0,0 +1,131 @@
+"""
+Sends custom resource responses to CloudFormation. Connections to the response endpoint are kept alive and reused by
+warm containers, and PUTs that fail with a server error or a connection error are retried with jittered exponential
+backoff. Can be used as a drop-in replacement for the cfnresponse module.
+"""
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+# CloudFormation rejects response bodies larger than 4096 bytes
+MAX_RESPONSE_SIZE = 4096
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 8.0
+CONNECT_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+# idle connections keyed by (scheme, host, port)
+_idle = {}
+_idle_lock = threading.Lock()
+
+
+class ResponseError(Exception):
+    pass
+
+
+def send(event, context, response_status, response_data, physical_resource_id=None, no_echo=False, reason=None):
+    """
+    Build and send a response for event, with the same arguments as cfnresponse.send
+    """
+    body = build_body(event, context, response_status, response_data, physical_resource_id, no_echo, reason)
+    return put(event['ResponseURL'], body)
+
+
+def build_body(event, context, response_status, response_data, physical_resource_id=None, no_echo=False,
+               reason=None):
+    body = {
+        'Status': response_status,
+        'Reason': reason or 'See the details in CloudWatch Log Stream: ' + context.log_stream_name,
+        'PhysicalResourceId': physical_resource_id or context.log_stream_name,
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'NoEcho': no_echo
+    }
+    if response_data:
+        body['Data'] = response_data
+    return body
+
+
+def encode_body(body):
+    """
+    Serialise a response body, shortening the reason and then dropping the data if it is over the size limit. A body
+    that only fits without its data is turned into a failure so that the stack does not silently miss attributes
+    """
+    encoded = json.dumps(body)
+    if len(encoded) <= MAX_RESPONSE_SIZE:
+        return encoded
+    body = dict(body)
+    if 'Reason' in body:
+        overflow = len(encoded) - MAX_RESPONSE_SIZE
+        body['Reason'] = body['Reason'][:max(128, len(body['Reason']) - overflow - 3)] + '...'
+        encoded = json.dumps(body)
+    if len(encoded) > MAX_RESPONSE_SIZE and 'Data' in body:
+        logger.error("Response data is %s bytes, dropping it and failing the resource" % len(json.dumps(body['Data'])))
+        del body['Data']
+        body['Status'] = FAILED
+        body['Reason'] = 'Response exceeds the %s byte limit for custom resource responses' % MAX_RESPONSE_SIZE
+        encoded = json.dumps(body)
+    if len(encoded) > MAX_RESPONSE_SIZE:
+        raise ResponseError("Response is %s bytes, which is over the %s byte limit" % (len(encoded),
+                                                                                          MAX_RESPONSE_SIZE))
+    return encoded
+
+
+def _acquire(scheme, host, port):
+    with _idle_lock:
+        connections = _idle.get((scheme, host, port))
+        if connections:
+            return connections.pop()
+    if scheme == 'https':
+        return http.client.HTTPSConnection(host, port, timeout=CONNECT_TIMEOUT)
+    return http.client.HTTPConnection(host, port, timeout=CONNECT_TIMEOUT)
+
+
+def _release(scheme, host, port, connection):
+    with _idle_lock:
+        _idle.setdefault((scheme, host, port), []).append(connection)
+
+
+def put(response_url, body):
+    """
+    PUT a response body to the pre-signed response url. Returns the http status, number of attempts and the
+    duration in milliseconds, raises ResponseError once all attempts have failed
+    """
+    encoded = encode_body(body).encode('utf-8')
+    url = urllib.parse.urlparse(response_url)
+    path = url.path + ('?' + url.query if url.query else '')
+    headers = {'content-type': '', 'content-length': str(len(encoded))}
+    start = time.time()
+    error = None
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        connection = _acquire(url.scheme, url.hostname, url.port)
+        try:
+            connection.request('PUT', path, body=encoded, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            error = "%s: %s" % (type(e).__name__, e)
+        else:
+            _release(url.scheme, url.hostname, url.port, connection)
+            if response.status < 500:
+                stats = {'status': response.status, 'attempts': attempt,
+                         'duration': int((time.time() - start) * 1000)}
+                if response.status >= 400:
+                    logger.error("CloudFormation rejected the response: %s %s" % (response.status, response.reason))
+                return stats
+            error = "%s %s" % (response.status, response.reason)
+        logger.warning("Sending response failed on attempt %s: %s" % (attempt, error))
+        if attempt < MAX_ATTEMPTS:
+            time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+    raise ResponseError("Failed to send response after %s attempts: %s" % (MAX_ATTEMPTS, error))
@@ -0,0 +1 @@
+../../patterns/CfnResponse/cfn_response.py
\ No newline at end of file
@@ -1,14 +1,48 @@
 """This AWS Lambda Function kicks off a code build job."""
-import http.client
+import hashlib
+import io
+import os
+import time
+import zipfile
 import urllib.parse
 import json
 import boto3
 import traceback
+import cfn_response
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+# concurrent BatchDeleteImage calls while cleaning up a repository
+CLEANUP_CONCURRENCY = int(os.environ.get('CLEANUP_CONCURRENCY', 4))
+# seconds before the Lambda deadline at which the cleanup hands over to a new invocation
+CLEANUP_RESERVE = float(os.environ.get('CLEANUP_RESERVE', 30))
+# give up after this many invocations for one Delete request
+CLEANUP_MAX_INVOCATIONS = int(os.environ.get('CLEANUP_MAX_INVOCATIONS', 10))
+# BatchDeleteImage accepts at most 100 image ids per call
+DELETE_BATCH_SIZE = 100
+# seconds between build status checks in batch mode
+BUILD_POLL_INTERVAL = float(os.environ.get('BUILD_POLL_INTERVAL', 10))
+# seconds before the Lambda deadline at which build tracking hands over to a new invocation
+BUILD_RESERVE = float(os.environ.get('BUILD_RESERVE', 30))
+# fail batch builds that have not finished after this many seconds, CloudFormation gives up after an hour
+BUILD_TIMEOUT = int(os.environ.get('BUILD_TIMEOUT', 3300))
+# concurrent StartBuild calls in batch mode
+BUILD_CONCURRENCY = int(os.environ.get('BUILD_CONCURRENCY', 8))
+# prefix of the S3 cache locations when CachePolicy is S3
+CACHE_PREFIX = os.environ.get('CACHE_PREFIX', 'codebuild-cache')
+# largest source bundle downloaded to hash its Dockerfile for the S3 cache key
+CACHE_MAX_BUNDLE_SIZE = int(os.environ.get('CACHE_MAX_BUNDLE_SIZE', 10 * 1024 * 1024))
+CACHE_POLICIES = ['NONE', 'LOCAL', 'S3', 'REGISTRY']
+# physical id signalled by the buildspec, every response uses it so CloudFormation never replaces the resource
+PHYSICAL_RESOURCE_ID = "1233244324"
+# resource properties that don't change what is built
+UNBUILT_PROPERTIES = ['ServiceToken', 'SkipUnchanged', 'ECRRepositories', 'Name', 'CachePolicy', 'CacheBucket']
 
 
 def lambda_handler(event, context):
     """Main Lambda Handling function."""
     account_id = context.invoked_function_arn.split(":")[4]
+    region = context.invoked_function_arn.split(":")[3]
 
     try:
         # Log the received event
@@ -19,9 +53,23 @@ def lambda_handler(event, context):
 
         # CREATE UPDATE (want to avoid rebuilds unless something changed)
         if event['RequestType'] in ("Create", "Update"):
+            if 'Images' in event['ResourceProperties']:
+                return build_images(event, context, account_id, response)
             try:
+                projects = {}
+                clients = build_clients()
+                fingerprint = build_fingerprint(event['ResourceProperties'], clients, projects)
+                if fingerprint and is_enabled(event, 'SkipUnchanged', 'SKIP_UNCHANGED', 'true'):
+                    image = find_image(clients['ecr'], account_id, event['ResourceProperties']['ECRRepository'],
+                                       fingerprint, event['ResourceProperties'].get('ImageTag', 'latest'))
+                    if image:
+                        print("Image %s was built from the same inputs, skipping the build" % image['ImageUri'])
+                        response['PhysicalResourceId'] = PHYSICAL_RESOURCE_ID
+                        response['Data'] = image
+                        return send_response(event, response)
                 print("Kicking off Build")
-                execute_build(event)
+                execute_build(event, fingerprint,
+                              cache_settings(event['ResourceProperties'], account_id, region, projects, clients))
             except Exception as build_exce:
                 print("ERROR: Build threw exception")
                 print((repr(build_exce)))
@@ -33,13 +81,18 @@ def lambda_handler(event, context):
                 print("Build Kicked off ok CodeBuild should signal back")
                 return
         elif event['RequestType'] == "Delete":
-            # TODO: Remove the created images in the Repositories
             print("Delete event remove container images")
-            response['PhysicalResourceId'] = "1233244324"
+            response['PhysicalResourceId'] = PHYSICAL_RESOURCE_ID
             try:
-                resources = event['ResourceProperties']
-                repository = resources['ECRRepository']
-                cleanup_images_repo(repository, account_id)
+                # a Delete that ran out of time carries the progress of the previous invocation
+                progress = event.get('CleanupProgress') or {
+                    'Repositories': get_repositories(event['ResourceProperties']),
+                    'Deleted': 0,
+                    'Invocations': 0
+                }
+                if not cleanup_images(progress, account_id, context):
+                    resume_cleanup(event, progress, context)
+                    return
             except Exception as cleanup_exception:
                 # signal failure to CFN
                 print((json.dumps(event, indent=2)))
@@ -49,6 +102,7 @@ def lambda_handler(event, context):
                 print((repr(cleanup_exception)))
                 return send_response(event, response, "FAILED",
                                      "Cleanup of Container image failed." + repr(cleanup_exception))
+            print("Deleted %s image(s)" % progress['Deleted'])
             # signal success to CFN
             return send_response(event, response)
         else:
@@ -61,35 +115,293 @@ def lambda_handler(event, context):
                              "Unhandled exception, failing gracefully: " + str(unhandled))
 
 
-def cleanup_images_repo(repository, account_id):
+def get_repositories(resources):
     """
-    Delete Container images
+    Repositories to clean up, ECRRepository and/or a list of ECRRepositories
+    """
+    repositories = []
+    if resources.get('ECRRepository'):
+        repositories.append(resources['ECRRepository'])
+    for repository in resources.get('ECRRepositories', []) + [i.get('ECRRepository') for i in
+                                                               resources.get('Images', [])]:
+        if repository and repository not in repositories:
+            repositories.append(repository)
+    return repositories
+
+
+def out_of_time(context, reserve=CLEANUP_RESERVE):
+    return context.get_remaining_time_in_millis() / 1000.0 < reserve
+
+
+def cleanup_images(progress, account_id, context):
+    """
+    Delete the images in every repository in progress, removing repositories from the list as they are emptied.
+    Returns False if the invocation ran out of time first
     """
     ecr_client = boto3.client('ecr')
+    with ThreadPoolExecutor(max_workers=CLEANUP_CONCURRENCY) as executor:
+        while progress['Repositories']:
+            deleted, complete = cleanup_images_repo(ecr_client, executor, progress['Repositories'][0],
+                                                    account_id, context)
+            progress['Deleted'] += deleted
+            if not complete:
+                return False
+            progress['Repositories'].pop(0)
+    return True
+
 
+def cleanup_images_repo(ecr_client, executor, repository, account_id, context):
+    """
+    Delete Container images. Pages of image ids are deleted in batches on the executor while the next page is
+    listed, then the repository is listed again until it is empty, as images can be skipped by a listing that runs
+    while deletes are in progress. Returns the number of images deleted and whether the repository is empty
+    """
     print(("Repo:" + repository + " AccountID:" + account_id))
-    response = ecr_client.describe_images(
+    deleted = 0
+    while True:
+        batches = []
+        seen = set()
+        try:
+            pages = ecr_client.get_paginator('list_images').paginate(
+                registryId=account_id,
+                repositoryName=repository,
+                PaginationConfig={'PageSize': 1000}
+            )
+            for page in pages:
+                # tagged images are listed once per tag
+                image_ids = []
+                for image_id in page['imageIds']:
+                    if image_id['imageDigest'] not in seen:
+                        seen.add(image_id['imageDigest'])
+                        image_ids.append({'imageDigest': image_id['imageDigest']})
+                for i in range(0, len(image_ids), DELETE_BATCH_SIZE):
+                    batches.append(executor.submit(delete_images, ecr_client, repository, account_id,
+                                                   image_ids[i:i + DELETE_BATCH_SIZE]))
+                if out_of_time(context):
+                    break
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'RepositoryNotFoundException':
+                raise
+            print("Repository %s does not exist" % repository)
+            return deleted, True
+        if not batches:
+            return deleted, True
+        failures = []
+        deleted_now = 0
+        for batch in batches:
+            count, batch_failures = batch.result()
+            deleted_now += count
+            failures += batch_failures
+        deleted += deleted_now
+        print("Deleted %s image(s) from %s" % (deleted_now, repository))
+        if failures and not deleted_now:
+            raise Exception("Failed to delete images from %s: %s" % (repository, json.dumps(failures[:5])))
+        if out_of_time(context):
+            return deleted, False
+
+
+def delete_images(ecr_client, repository, account_id, image_ids):
+    """
+    Delete a batch of at most DELETE_BATCH_SIZE images, images that are already gone don't count as failures
+    """
+    response = ecr_client.batch_delete_image(
         registryId=account_id,
-        repositoryName=repository
+        repositoryName=repository,
+        imageIds=image_ids
     )
-    image_ids = []
-    for imageDetail in response['imageDetails']:
-        image_ids.append(
-                {
-                    'imageDigest': imageDetail['imageDigest'],
-                }
-        )
+    failures = [f for f in response.get('failures', []) if f.get('failureCode') != 'ImageNotFound']
+    return len(response['imageIds']), failures
+
+
+def resume_cleanup(event, progress, context):
+    """
+    Hand the remaining cleanup over to a new asynchronous invocation of this function
+    """
+    progress['Invocations'] += 1
+    if progress['Invocations'] >= CLEANUP_MAX_INVOCATIONS:
+        raise Exception("Cleanup did not finish within %s invocations, %s image(s) deleted" %
+                        (CLEANUP_MAX_INVOCATIONS, progress['Deleted']))
+    print("Running out of time after deleting %s image(s), continuing in a new invocation" % progress['Deleted'])
+    event['CleanupProgress'] = progress
+    reinvoke(event, context)
+
+
+def reinvoke(event, context):
+    """
+    Continue handling event in a new asynchronous invocation of this function
+    """
+    boto3.client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event)
+    )
+
+
+def is_enabled(event, prop, env_var, default='false'):
+    """
+    Resource property prop, falling back to the environment variable env_var
+    """
+    value = event.get('ResourceProperties', {}).get(prop, os.environ.get(env_var, default))
+    return str(value).lower() in ['true', 'yes', '1']
+
+
+def build_clients():
+    """
+    The clients used to fingerprint and start builds. Batch mode shares them between its worker threads, so they are
+    created up front on the calling thread: clients are thread safe, boto3's default session that creates them isn't
+    """
+    return {service: boto3.client(service) for service in ['codebuild', 's3', 'ecr']}
+
+
+def build_fingerprint(props, clients, projects=None):
+    """
+    Hash of the inputs of a build: the resource properties (or image spec), the build project's source and
+    environment and the ETag of its S3 source bundle. Returns None if the source is not in S3 or can't be inspected,
+    changes to it can't be detected so such builds always run. projects caches the lookups by project name
+    """
+    projects = {} if projects is None else projects
+    try:
+        project, head = project_inputs_cached(props['BuildProjectName'], projects, clients)
+    except Exception as e:
+        print("Can't fingerprint the build, it will always run: %s" % repr(e))
+        return None
+    if head is None:
+        return None
+    inputs = [
+        {k: v for k, v in props.items() if k not in UNBUILT_PROPERTIES},
+        {k: project.get(k) for k in ['source', 'secondarySources', 'environment']},
+        head['ETag'],
+        head.get('VersionId')
+    ]
+    return 'build-' + hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def project_inputs(project_name, clients):
+    """
+    The project definition and the HeadObject response of its source bundle, which is None if the source is not in S3
+    """
+    project = clients['codebuild'].batch_get_projects(names=[project_name])['projects'][0]
+    source = project['source']
+    if source['type'] != 'S3':
+        print("Build source of %s is %s, the build can't be fingerprinted" % (project_name, source['type']))
+        return project, None
+    bucket, key = source['location'].split('/', 1)
+    return project, clients['s3'].head_object(Bucket=bucket, Key=key)
+
+
+def cache_settings(props, account_id, region, projects, clients):
+    """
+    StartBuild arguments and environment variable overrides for the CachePolicy property:
+    NONE keeps the project's cache settings,
+    LOCAL caches Docker layers and the source on the build host,
+    S3 saves the built image to an S3 cache keyed by repository and Dockerfile hash, loaded by the next build and
+    REGISTRY pulls the last image pushed to the repository and builds with --cache-from
+    """
+    policy = props.get('CachePolicy', 'NONE').upper()
+    if policy not in CACHE_POLICIES:
+        raise Exception("CachePolicy must be one of %s" % ", ".join(CACHE_POLICIES))
+    args = {}
+    env = [{'name': 'cfn_cache_policy', 'value': policy}]
+    if policy == 'LOCAL':
+        args['cacheOverride'] = {'type': 'LOCAL', 'modes': ['LOCAL_DOCKER_LAYER_CACHE', 'LOCAL_SOURCE_CACHE']}
+    elif policy == 'S3':
+        bucket = props.get('CacheBucket')
+        project = project_inputs_cached(props['BuildProjectName'], projects, clients)[0]
+        if not bucket:
+            if project['source']['type'] != 'S3':
+                raise Exception("CacheBucket is required when the build source is not in S3")
+            bucket = project['source']['location'].split('/', 1)[0]
+        location = '/'.join([bucket, CACHE_PREFIX, props['ECRRepository'], dockerfile_hash(props, projects, clients)])
+        args['cacheOverride'] = {'type': 'S3', 'location': location}
+    elif policy == 'REGISTRY':
+        env.append({'name': 'cfn_cache_from', 'value': "%s.dkr.ecr.%s.amazonaws.com/%s:%s" % (
+            account_id, region, props['ECRRepository'], props.get('ImageTag', 'latest'))})
+    return args, env
+
+
+def project_inputs_cached(project_name, projects, clients):
+    if project_name not in projects:
+        projects[project_name] = project_inputs(project_name, clients)
+    return projects[project_name]
 
-    if len(image_ids):
-        # delete images
-        response = ecr_client.batch_delete_image(
+
+def dockerfile_hash(props, projects, clients):
+    """
+    Hash of the Dockerfile in the project's S3 source bundle, or of the whole bundle if it is too large to download
+    or has no Dockerfile, so the S3 cache is only shared by builds of the same Dockerfile
+    """
+    project, head = project_inputs_cached(props['BuildProjectName'], projects, clients)
+    if head is None:
+        return hashlib.sha256(json.dumps(project['source'], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    if head['ContentLength'] <= CACHE_MAX_BUNDLE_SIZE:
+        bucket, key = project['source']['location'].split('/', 1)
+        bundle = clients['s3'].get_object(Bucket=bucket, Key=key, IfMatch=head['ETag'])['Body'].read()
+        with zipfile.ZipFile(io.BytesIO(bundle)) as z:
+            if props.get('Dockerfile', 'Dockerfile') in z.namelist():
+                return hashlib.sha256(z.read(props.get('Dockerfile', 'Dockerfile'))).hexdigest()[:16]
+    return hashlib.sha256(head['ETag'].encode('utf-8')).hexdigest()[:16]
+
+
+def find_image(ecr_client, account_id, repository, fingerprint, image_tag='latest'):
+    """
+    The response data of an image in repository tagged with fingerprint by an earlier build, None if there is none.
+    The image is tagged with image_tag again, as the build would have, in case a later build moved the tag
+    """
+    try:
+        images = ecr_client.describe_images(
+            registryId=account_id,
+            repositoryName=repository,
+            imageIds=[{'imageTag': fingerprint}]
+        )['imageDetails']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['ImageNotFoundException', 'RepositoryNotFoundException']:
+            raise
+        return None
+    if not images:
+        return None
+    if image_tag not in images[0].get('imageTags', []):
+        retag_image(ecr_client, account_id, repository, images[0]['imageDigest'], image_tag)
+    region = ecr_client.meta.region_name
+    return image_data(account_id, region, repository, images[0]['imageDigest'], fingerprint)
+
+
+def retag_image(ecr_client, account_id, repository, digest, image_tag):
+    image = ecr_client.batch_get_image(
+        registryId=account_id,
+        repositoryName=repository,
+        imageIds=[{'imageDigest': digest}]
+    )['images'][0]
+    args = {'imageManifestMediaType': image['imageManifestMediaType']} if 'imageManifestMediaType' in image else {}
+    print("Tagging %s@%s as %s" % (repository, digest, image_tag))
+    try:
+        ecr_client.put_image(
             registryId=account_id,
             repositoryName=repository,
-            imageIds=image_ids
+            imageManifest=image['imageManifest'],
+            imageTag=image_tag,
+            **args
         )
+    except ClientError as e:
+        # the tag already points at this image
+        if e.response['Error']['Code'] != 'ImageAlreadyExistsException':
+            raise
+
+
+def image_data(account_id, region, repository, digest, fingerprint, cache_source='image', cached_steps=''):
+    """
+    Response data for an image, the buildspec signals the same keys. An image that was reused rather than built
+    has the cache source "image"
+    """
+    return {
+        'ImageUri': "%s.dkr.ecr.%s.amazonaws.com/%s@%s" % (account_id, region, repository, digest),
+        'ImageDigest': digest,
+        'Fingerprint': fingerprint,
+        'CacheSource': cache_source,
+        'CachedSteps': cached_steps
+    }
 
 
-def execute_build(event):
+def execute_build(event, fingerprint=None, cache=({}, [])):
     """Kickoff CodeBuild Project."""
     build = boto3.client('codebuild')
     project_name = event["ResourceProperties"]["BuildProjectName"]
@@ -105,11 +417,185 @@ def execute_build(event):
             {'name': 'cfn_signal_url', 'value': signal_url},
             {'name': 'cfn_stack_id', 'value': stack_id},
             {'name': 'cfn_request_id', 'value': request_id},
-            {'name': 'cfn_logical_resource_id', 'value': logical_resource_id}
-        ])
+            {'name': 'cfn_logical_resource_id', 'value': logical_resource_id},
+            # the buildspec also tags the image with the fingerprint so that later requests can find it
+            {'name': 'cfn_build_fingerprint', 'value': fingerprint or 'placeholder'}
+        ] + cache[1], **cache[0])
     return response
 
 
+def build_images(event, context, account_id, response):
+    """
+    Batch mode, build every image in the Images property concurrently and signal CloudFormation once they are all
+    done. Builds are tracked by polling, handing over to a new invocation as the deadline approaches
+    """
+    try:
+        progress = event.get('BuildProgress') or start_image_builds(event, account_id,
+                                                                    context.invoked_function_arn.split(":")[3])
+        if not wait_for_builds(progress, context):
+            progress['Invocations'] += 1
+            event['BuildProgress'] = progress
+            print("Builds are still running, continuing in a new invocation")
+            reinvoke(event, context)
+            return
+    except Exception as build_exce:
+        print("ERROR: Build threw exception")
+        traceback.print_exc()
+        return send_response(event, get_response_dict(event), "FAILED", repr(build_exce))
+    response['PhysicalResourceId'] = PHYSICAL_RESOURCE_ID
+    failed = ["%s: %s" % (name, image['Error']) for name, image in sorted(progress['Images'].items())
+              if 'Error' in image]
+    if failed:
+        return send_response(event, response, "FAILED", "Image builds failed. " + "; ".join(failed))
+    response['Data'] = {}
+    for name, image in progress['Images'].items():
+        response['Data'][name + '.ImageUri'] = image['Data']['ImageUri']
+        response['Data'][name + '.ImageDigest'] = image['Data']['ImageDigest']
+        response['Data'][name + '.CacheSource'] = image['Data']['CacheSource']
+    return send_response(event, response)
+
+
+def image_specs(props):
+    """
+    The Images property keyed by Name. Images default to the resource's other properties, such as BuildProjectName
+    and ECRRepository, which are part of their fingerprint as for a single build
+    """
+    specs = {}
+    for image in props['Images']:
+        spec = {k: v for k, v in props.items() if k != 'Images'}
+        spec.setdefault('ImageTag', 'latest')
+        spec.update(image)
+        name = spec.get('Name', spec['ECRRepository'])
+        if name in specs:
+            raise Exception("Duplicate image name %s, give the images a unique Name" % name)
+        specs[name] = spec
+    return specs
+
+
+def start_image_builds(event, account_id, region):
+    """
+    Fingerprint every image, skip those that were already built and start one build per distinct fingerprint.
+    A build of the same fingerprint that is already running is joined instead of starting another one
+    """
+    specs = image_specs(event['ResourceProperties'])
+    skip_unchanged = is_enabled(event, 'SkipUnchanged', 'SKIP_UNCHANGED', 'true')
+    projects = {}
+    clients = build_clients()
+    progress = {'Started': int(time.time()), 'Invocations': 0, 'Images': {}}
+
+    def prepare(name):
+        spec = specs[name]
+        image = {'Repository': spec['ECRRepository'], 'Fingerprint': build_fingerprint(spec, clients, projects)}
+        if image['Fingerprint'] and skip_unchanged:
+            data = find_image(clients['ecr'], account_id, spec['ECRRepository'], image['Fingerprint'],
+                              spec['ImageTag'])
+            if data:
+                print("Image %s was built from the same inputs, skipping the build" % data['ImageUri'])
+                image['Data'] = data
+        return name, image
+
+    with ThreadPoolExecutor(max_workers=BUILD_CONCURRENCY) as executor:
+        progress['Images'] = dict(executor.map(prepare, specs))
+        # images with the same fingerprint are built once
+        groups = {}
+        for name, image in progress['Images'].items():
+            if 'Data' not in image:
+                groups.setdefault(image['Fingerprint'] or name, []).append(name)
+        running = running_builds(clients['codebuild'],
+                                 set(specs[names[0]]['BuildProjectName'] for names in groups.values()))
+
+        def start(names):
+            fingerprint = progress['Images'][names[0]]['Fingerprint']
+            if fingerprint and fingerprint in running:
+                print("Joining build %s of %s" % (running[fingerprint], ", ".join(names)))
+                return names, running[fingerprint]
+            build_id = start_image_build(clients['codebuild'], specs[names[0]], fingerprint,
+                                         cache_settings(specs[names[0]], account_id, region, projects, clients))
+            print("Started build %s of %s" % (build_id, ", ".join(names)))
+            return names, build_id
+
+        for names, build_id in executor.map(start, groups.values()):
+            for name in names:
+                progress['Images'][name]['BuildId'] = build_id
+    return progress
+
+
+def running_builds(codebuild, project_names):
+    """
+    Fingerprints of the builds in progress for the given projects, mapped to their build ids
+    """
+    if not project_names:
+        return {}
+    build_ids = []
+    for project_name in project_names:
+        # most recent builds first, older ones will have finished
+        build_ids += codebuild.list_builds_for_project(projectName=project_name, sortOrder='DESCENDING')['ids']
+    running = {}
+    for i in range(0, len(build_ids), 100):
+        for build in codebuild.batch_get_builds(ids=build_ids[i:i + 100])['builds']:
+            if build['buildStatus'] != 'IN_PROGRESS':
+                continue
+            env = {v['name']: v['value'] for v in build.get('environment', {}).get('environmentVariables', [])}
+            if env.get('cfn_build_fingerprint', 'placeholder') != 'placeholder':
+                running[env['cfn_build_fingerprint']] = build['id']
+    return running
+
+
+def start_image_build(codebuild, spec, fingerprint, cache=({}, [])):
+    """
+    Start the build of one image, the build doesn't signal CloudFormation itself
+    """
+    overrides = [
+        {'name': 'IMAGE_REPO_NAME', 'value': spec['ECRRepository']},
+        {'name': 'IMAGE_TAG', 'value': spec['ImageTag']},
+        {'name': 'cfn_build_fingerprint', 'value': fingerprint or 'placeholder'},
+        {'name': 'cfn_signal_url', 'value': 'placeholder'}
+    ]
+    for name, value in sorted(spec.get('EnvironmentVariables', {}).items()):
+        overrides.append({'name': name, 'value': str(value)})
+    response = codebuild.start_build(projectName=spec['BuildProjectName'],
+                                     environmentVariablesOverride=overrides + cache[1], **cache[0])
+    return response['build']['id']
+
+
+def wait_for_builds(progress, context):
+    """
+    Poll the builds in progress until every image is done. Returns False if the invocation is running out of time
+    """
+    codebuild = boto3.client('codebuild')
+    account_id, region = context.invoked_function_arn.split(":")[4], context.invoked_function_arn.split(":")[3]
+    while True:
+        pending = {}
+        for name, image in progress['Images'].items():
+            if 'Data' not in image and 'Error' not in image:
+                pending.setdefault(image['BuildId'], []).append(name)
+        if not pending:
+            return True
+        build_ids = list(pending)
+        for i in range(0, len(build_ids), 100):
+            for build in codebuild.batch_get_builds(ids=build_ids[i:i + 100])['builds']:
+                if build['buildStatus'] == 'IN_PROGRESS':
+                    continue
+                exported = {v['name']: v['value'] for v in build.get('exportedEnvironmentVariables', [])}
+                for name in pending[build['id']]:
+                    image = progress['Images'][name]
+                    if build['buildStatus'] != 'SUCCEEDED':
+                        image['Error'] = "build %s %s" % (build['id'], build['buildStatus'])
+                    elif not exported.get('IMAGE_DIGEST'):
+                        image['Error'] = "build %s did not export IMAGE_DIGEST" % build['id']
+                    else:
+                        image['Data'] = image_data(account_id, region, image['Repository'], exported['IMAGE_DIGEST'],
+                                                   image['Fingerprint'], exported.get('CACHE_SOURCE', 'none'),
+                                                   exported.get('CACHED_STEPS', '0'))
+        if all('Data' in image or 'Error' in image for image in progress['Images'].values()):
+            return True
+        if time.time() - progress['Started'] > BUILD_TIMEOUT:
+            raise Exception("Builds did not finish within %s seconds" % BUILD_TIMEOUT)
+        if out_of_time(context, BUILD_RESERVE + BUILD_POLL_INTERVAL):
+            return False
+        time.sleep(BUILD_POLL_INTERVAL)
+
+
 def get_response_dict(event):
     """Setup Response object for CFN Signal."""
     response = {
@@ -130,10 +616,8 @@ def send_response(event, response, status=None, reason=None):
         response['Reason'] = reason
 
     if 'ResponseURL' in event and event['ResponseURL']:
-        url = urllib.parse.urlparse(event['ResponseURL'])
-        body = json.dumps(response)
-        https = http.client.HTTPSConnection(url.hostname)
-        https.request('PUT', url.path+'?'+url.query, body)
-        print("Sent CFN Response")
+        stats = cfn_response.put(event['ResponseURL'], response)
+        print("Sent CFN Response, status %s after %s attempt(s) in %sms" %
+              (stats['status'], stats['attempts'], stats['duration']))
 
     return response
@@ -1,21 +1,20 @@
-import boto3
+import hashlib
+import os
 import random
 import string
 import logging
 import threading
-import urllib3  # Added by EM
+import time
 import json
-from botocore.credentials import (
-    AssumeRoleCredentialFetcher,
-    CredentialResolver,
-    DeferredRefreshableCredentials
-)
-from botocore.session import Session
-from botocore.exceptions import ClientError
+import urllib.parse
+import cfn_response
+import metrics
+import rate_limit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from poll_state import get_state_store
 
 
-http = urllib3.PoolManager()  # Added by EM
-
 cfn_states = {
     "failed": ["CREATE_FAILED", "ROLLBACK_IN_PROGRESS", "ROLLBACK_FAILED", "ROLLBACK_COMPLETE", "DELETE_FAILED",
                "UPDATE_ROLLBACK_IN_PROGRESS", "UPDATE_ROLLBACK_FAILED", "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
@@ -25,6 +24,47 @@ cfn_states = {
     "success": ["CREATE_COMPLETE", "DELETE_COMPLETE", "UPDATE_COMPLETE"]
 }
 
+# Lifetime of assumed role sessions, and how long before expiry a cached client stops being handed out
+ASSUME_ROLE_DURATION = int(os.environ.get('ASSUME_ROLE_DURATION', 3600))
+CLIENT_CACHE_SIZE = int(os.environ.get('CLIENT_CACHE_SIZE', 64))
+CLIENT_CACHE_EXPIRY_MARGIN = int(os.environ.get('CLIENT_CACHE_EXPIRY_MARGIN', 300))
+# Inline polling backoff bounds, and the time kept back to register a scheduled poll if the stack is still running
+INLINE_POLL_MIN_DELAY = float(os.environ.get('INLINE_POLL_MIN_DELAY', 2))
+INLINE_POLL_MAX_DELAY = float(os.environ.get('INLINE_POLL_MAX_DELAY', 30))
+INLINE_POLL_RESERVE = float(os.environ.get('INLINE_POLL_RESERVE', 30))
+# Shared poller: a single scheduled rule that resolves all pending stack operations recorded in the state store
+POLL_MODE = os.environ.get('POLL_MODE', 'rule')
+SHARED_POLL_RULE = os.environ.get('SHARED_POLL_RULE', 'QuickStartStackMaker-SharedPoller')
+SHARED_POLL_SCHEDULE = os.environ.get('SHARED_POLL_SCHEDULE', 'rate(1 minute)')
+# Pending stacks per account/region above which a tick lists all stacks instead of describing each one
+SHARED_POLL_LIST_THRESHOLD = int(os.environ.get('SHARED_POLL_LIST_THRESHOLD', 10))
+# Seconds after which a pending operation that cannot be resolved is failed and dropped
+SHARED_POLL_MAX_AGE = int(os.environ.get('SHARED_POLL_MAX_AGE', 3600))
+# Default number of stacks created, updated, deleted or described in parallel in fan-out mode
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', 8))
+# Tag holding a hash of the template url and ETag, parameters and capabilities a child stack was last deployed with
+FINGERPRINT_TAG = 'QuickStartFingerprint'
+# Allowance for clock skew when ignoring stack events that predate the current operation
+EVENT_CLOCK_SKEW = 5
+# Seconds a parent stack's properties are reused by a warm container for its other children, 0 to always describe it
+PARENT_CACHE_TTL = int(os.environ.get('PARENT_CACHE_TTL', 60))
+# Seconds a template summary is reused, summaries are keyed by template url and S3 ETag so they don't go stale
+TEMPLATE_SUMMARY_TTL = int(os.environ.get('TEMPLATE_SUMMARY_TTL', 3600))
+# Parent stack properties copied to child stacks
+PARENT_PROPERTIES = ['Capabilities', 'DisableRollback', 'NotificationARNs', 'RollbackConfiguration', 'Tags']
+# Version of the poll state passed to scheduled polls, polls of a newer version than this are refused
+POLL_STATE_VERSION = 1
+# EventBridge rejects target Input over 8192 characters
+POLL_INPUT_LIMIT = 8192
+# Length of the unique id at the end of a stack arn, used to size fan-out state before the stacks exist
+STACK_ID_SUFFIX_LENGTH = 36
+# Key prefix of fan-out state kept in the state store for rule polls, the shared poller skips these keys
+POLL_STATE_PREFIX = 'poll-state/'
+# Resource properties carried in the poll state, only the ones log_config reads
+POLL_PROPERTIES = ['loglevel', 'botolevel']
+# Deletion policies under which a resource is deleted with its stack, teardown leaves the stacks of other resources
+DELETED_POLICIES = ['Delete', 'Snapshot']
+
 
 def log_config(event, loglevel=None, botolevel=None):
     if 'ResourceProperties' in event.keys():
@@ -45,6 +85,9 @@ def log_config(event, loglevel=None, botolevel=None):
     logging.getLogger('botocore').setLevel(botolevel)
     # Set log message format
     logfmt = '[%(requestid)s][%(asctime)s][%(levelname)s] %(message)s \n'
+    if not mainlogger.handlers:
+        # outside of the Lambda runtime, e.g. when benchmarking locally
+        mainlogger.addHandler(logging.StreamHandler())
     mainlogger.handlers[0].setFormatter(logging.Formatter(logfmt))
     return logging.LoggerAdapter(mainlogger, {'requestid': event['RequestId']})
 
@@ -75,21 +118,16 @@ def send(event, context, response_status, response_data, physical_resource_id, l
     if response_data and response_data != {} and response_data != [] and isinstance(response_data, dict):
         response_body['Data'] = response_data
 
-    json_response_body = json.dumps(response_body)
-
-    logger.debug("Response body:\n" + json_response_body)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_response_body))
-    }
+    logger.debug("Response body:\n" + json.dumps(response_body))
 
     try:
-        response = http.request('PUT', response_url, headers=headers, body=json_response_body)
-
-        logger.info("CloudFormation returned status code: " + response.reason)
+        stats = cfn_response.put(response_url, response_body)
+        metrics.recorder.record('cloudformation-response', 'PUT', stats['duration'], stats['attempts'] - 1,
+                                str(stats['status']) if stats['status'] >= 400 else None)
+        logger.info("CloudFormation returned status code %s after %s attempt(s) in %sms" %
+                    (stats['status'], stats['attempts'], stats['duration']))
     except Exception as e:
-        logger.error("send(..) failed executing requests.put(..): " + str(e))
+        logger.error("send(..) failed to PUT the response: " + str(e))
         raise
 
 
@@ -100,7 +138,7 @@ def timeout(event, context, logger):
 
 
 # Handler function
-def cfn_handler(event, context, create_func, update_func, delete_func, logger, init_failed):
+def cfn_handler(event, context, create_func, update_func, delete_func, logger):
 
     logger.info("Lambda RequestId: %s CloudFormation RequestId: %s" %
                 (context.aws_request_id, event['RequestId']))
@@ -115,11 +153,8 @@ def cfn_handler(event, context, create_func, update_func, delete_func, logger, i
     physical_resource_id = None
 
     logger.debug("EVENT: " + json.dumps(event))
-    # handle init failures
-    if init_failed:
-        send(event, context, "FAILED", response_data, physical_resource_id, init_failed, logger)
-        raise init_failed
-
+    # decided before the handlers run, a request that registers its poll gets the poll's keys added to it
+    polling = scheduled_poll(event)
     # Setup timer to catch timeouts
     t = threading.Timer((context.get_remaining_time_in_millis()/1000.00)-0.5,
                         timeout, args=[event, context, logger])
@@ -128,7 +163,7 @@ def cfn_handler(event, context, create_func, update_func, delete_func, logger, i
     try:
         # Execute custom resource handlers
         logger.info("Received a %s Request" % event['RequestType'])
-        if 'Poll' in event.keys():
+        if polling:
             physical_resource_id, response_data = poll(event, context)
         elif event['RequestType'] == 'Create':
             physical_resource_id, response_data = create_func(event, context)
@@ -139,8 +174,8 @@ def cfn_handler(event, context, create_func, update_func, delete_func, logger, i
 
         if "Complete" in response_data.keys():
             # Removing lambda schedule for poll
-            if 'Poll' in event.keys():
-                remove_poll(event, context)
+            if polling and not remove_poll(event, context):
+                return
 
             logger.info("Completed successfully, sending response to cfn")
             send(event, context, "SUCCESS", cleanup_response(response_data), physical_resource_id, logger=logger)
@@ -149,14 +184,27 @@ def cfn_handler(event, context, create_func, update_func, delete_func, logger, i
 
     # Catch any exceptions, log the stacktrace, send a failure back to
     # CloudFormation and then raise an exception
+    except rate_limit.RequestBudgetExceeded as e:
+        if polling:
+            # the poll rule fires again, so a poll that ran out of budget just tries again on the next tick
+            logger.warning("%s, polling again on the next tick" % e)
+            return
+        logger.error(e, exc_info=True)
+        rollback_poll(event, context, logger)
+        send(event, context, "FAILED", cleanup_response(response_data), physical_resource_id, reason=str(e),
+             logger=logger)
     except Exception as e:
         reason = str(e)
         logger.error(e, exc_info=True)
-        try:
-            remove_poll(event, context)
-        except Exception as e2:
-            logger.error("Failed to remove polling event")
-            logger.error(e2, exc_info=True)
+        if polling:
+            try:
+                if not remove_poll(event, context):
+                    return
+            except Exception as e2:
+                logger.error("Failed to remove polling event")
+                logger.error(e2, exc_info=True)
+        else:
+            rollback_poll(event, context, logger)
         send(event, context, "FAILED", cleanup_response(response_data), physical_resource_id, reason=reason, logger=logger)
     finally:
         t.cancel()
@@ -176,16 +224,19 @@ class AssumeRoleProvider(object):
         self._fetcher = fetcher
 
     def load(self):
+        from botocore.credentials import DeferredRefreshableCredentials
         return DeferredRefreshableCredentials(
             self._fetcher.fetch_credentials,
             self.METHOD
         )
 
 
-def assume_role(session: Session,
+def assume_role(session: 'Session',
                 role_arn: str,
                 duration: int = 3600,
-                session_name: str = None) -> Session:
+                session_name: str = None) -> 'Session':
+    from botocore.credentials import AssumeRoleCredentialFetcher, CredentialResolver
+    from botocore.session import Session
     # noinspection PyTypeChecker
     fetcher = AssumeRoleCredentialFetcher(
         session.create_client,
@@ -204,10 +255,76 @@ def assume_role(session: Session,
     return role_session
 
 
+class TTLCache(object):
+    """
+    Bounded, thread safe LRU cache whose entries expire at a fixed time. Lives at module level so that warm
+    containers reuse entries across invocations.
+    """
+
+    def __init__(self, max_size, expiry_margin=0):
+        self.max_size = max_size
+        self.expiry_margin = expiry_margin
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if time.time() < expires_at - self.expiry_margin:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value, expires_at=float('inf')):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+# assumed role sessions keyed by role arn, and clients keyed by (role_arn, region, service)
+session_cache = TTLCache(CLIENT_CACHE_SIZE, CLIENT_CACHE_EXPIRY_MARGIN)
+client_cache = TTLCache(CLIENT_CACHE_SIZE, CLIENT_CACHE_EXPIRY_MARGIN)
+client_lock = threading.Lock()
+# id of the newest stack event already read, keyed by stack id
+event_cursors = TTLCache(1024)
+# parent stack properties keyed by parent stack id, and template summaries keyed by (template url, etag)
+parent_cache = TTLCache(64)
+template_summaries = TTLCache(64)
+
+
 def rand_string(l):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(l))
 
 
+def is_enabled(event, prop, env_var, default='false'):
+    """
+    Boolean switch read from the resource properties, falling back to the function's environment
+    """
+    value = event.get('ResourceProperties', {}).get(prop, os.environ.get(env_var, default))
+    return str(value).lower() in ['true', 'yes', '1']
+
+
 def get_cfn_parameters(event):
     params = []
     for p in event['ResourceProperties']['CfnParameters'].keys():
@@ -217,7 +334,7 @@ def get_cfn_parameters(event):
 
 def add_permission(context, rule_arn):
     sid = 'QuickStartStackMaker-' + rand_string(8)
-    lambda_client.add_permission(
+    local_client("lambda").add_permission(
         FunctionName=context.function_name,
         StatementId=sid,
         Action='lambda:InvokeFunction',
@@ -228,7 +345,7 @@ def add_permission(context, rule_arn):
 
 
 def put_rule():
-    response = events_client.put_rule(
+    response = local_client("events").put_rule(
         Name='QuickStartStackMaker-' + rand_string(8),
         ScheduleExpression='rate(2 minutes)',
         State='ENABLED',
@@ -237,92 +354,581 @@ def put_rule():
     return response["RuleArn"]
 
 
-def put_targets(func_name, event):
-    region = event['rule'].split(":")[3]
-    account_id = event['rule'].split(":")[4]
-    rule_name = event['rule'].split("/")[1]
-    events_client.put_targets(
+def put_targets(func_name, state):
+    region = state['rule'].split(":")[3]
+    account_id = state['rule'].split(":")[4]
+    rule_name = state['rule'].split("/")[1]
+    target_input = json.dumps(state)
+    if len(target_input) > POLL_INPUT_LIMIT:
+        raise Exception("Poll state is %s characters, over the %s character EventBridge Input limit" % (
+            len(target_input), POLL_INPUT_LIMIT))
+    local_client("events").put_targets(
         Rule=rule_name,
         Targets=[
             {
                 'Id': '1',
                 'Arn': 'arn:aws:lambda:%s:%s:function:%s' % (region, account_id, func_name),
-                'Input': json.dumps(event)
+                'Input': target_input
             }
         ]
     )
 
 
 def remove_targets(rule_arn):
-    events_client.remove_targets(
-        Rule=rule_arn.split("/")[1],
-        Ids=['1']
-    )
+    from botocore.exceptions import ClientError
+    try:
+        local_client("events").remove_targets(
+            Rule=rule_arn.split("/")[1],
+            Ids=['1']
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
 
 
 def remove_permission(context, sid):
-    lambda_client.remove_permission(
-        FunctionName=context.function_name,
-        StatementId=sid
-    )
+    """
+    Remove the poll rule's invoke permission, returns False if it was already removed by an overlapping poll
+    """
+    from botocore.exceptions import ClientError
+    try:
+        local_client("lambda").remove_permission(
+            FunctionName=context.function_name,
+            StatementId=sid
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        return False
+    return True
 
 
 def delete_rule(rule_arn):
-    events_client.delete_rule(
-        Name=rule_arn.split("/")[1]
-    )
+    from botocore.exceptions import ClientError
+    try:
+        local_client("events").delete_rule(
+            Name=rule_arn.split("/")[1]
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+
+def shared_polling(event):
+    """
+    Whether the request is left to the shared poller. Its ticks run in other containers, so it needs a durable state
+    store, requests fall back to a rule of their own without one
+    """
+    if event.get('ResourceProperties', {}).get('PollMode', POLL_MODE) != 'shared':
+        return False
+    if not poll_state_store().durable:
+        loga.warning("PollMode shared needs POLL_STATE_TABLE, polling with a rule for this request instead")
+        return False
+    return True
+
+
+def scheduled_poll(event):
+    """
+    Whether the invocation is a poll rule's tick. Its Input is the poll state, or the full request with the rule for
+    rules created by earlier versions of the function
+    """
+    return 'PollVersion' in event.keys() or 'rule' in event.keys()
 
 
 def setup_poll(event, context):
-    event['rule'] = put_rule()
-    event['permission'] = add_permission(context, event['rule'])
-    put_targets(context.function_name, event)
+    """
+    Register the poll of a request. The keys of everything registered are added to the request as it goes, so that
+    rollback_poll can undo a registration that fails part way
+    """
+    with rate_limit.limiter.essential():
+        if shared_polling(event):
+            register_shared_poll(event, context)
+            return
+        state = compact_poll_state(event, context)
+        if 'PollStateKey' in state.keys():
+            event['PollStateKey'] = state['PollStateKey']
+        event['rule'] = state['rule'] = put_rule()
+        event['permission'] = state['permission'] = add_permission(context, event['rule'])
+        put_targets(context.function_name, state)
+
+
+def rollback_poll(event, context, logger):
+    """
+    Remove whatever part of its poll a failed create, update or delete registered, nothing is left polling a request
+    that was answered FAILED
+    """
+    try:
+        with rate_limit.limiter.essential():
+            if 'SharedPollKey' in event.keys():
+                poll_state_store().delete(event['SharedPollKey'])
+            if 'permission' in event.keys():
+                remove_permission(context, event['permission'])
+            if 'rule' in event.keys():
+                remove_targets(event['rule'])
+                delete_rule(event['rule'])
+            if 'PollStateKey' in event.keys():
+                poll_state_store().delete(event['PollStateKey'])
+    except Exception as e:
+        logger.error("Failed to remove the partly registered poll")
+        logger.error(e, exc_info=True)
+
+
+def poll_state(event, context):
+    """
+    The part of a request that polls need: the ids and response url to answer CloudFormation with, where the stack
+    lives and the fan-out stacks. The resource properties are left out, the role and region are resolved here
+    """
+    props = event['ResourceProperties']
+    state = {
+        'Poll': True,
+        'PollVersion': POLL_STATE_VERSION,
+        'RequestType': event['RequestType'],
+        'ResponseURL': event['ResponseURL'],
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'PhysicalResourceId': event['PhysicalResourceId'],
+        'RoleArn': props.get('RoleArn'),
+        'Region': props.get('Region', function_region(context)),
+        'PollStart': event['PollStart'],
+        'TailEvents': is_enabled(event, 'TailEvents', 'TAIL_STACK_EVENTS', 'true'),
+        'ResourceProperties': {k: props[k] for k in POLL_PROPERTIES if k in props.keys()}
+    }
+    if 'FanOut' in event.keys():
+        state['FanOut'] = event['FanOut']
+        state['MaxConcurrency'] = max_concurrency(event)
+        state['StackIdOutputs'] = is_enabled(event, 'StackIdOutputs', 'STACK_ID_OUTPUTS')
+    return state
+
+
+def poll_state_size(state):
+    # leave room for the rule arn and permission id, which are added once the rule exists
+    return len(json.dumps(state)) + 256
+
+
+def check_poll_state(event, context):
+    """
+    Raise if the poll state of the request can't be handed to a poll rule, neither in the rule's Input nor in the
+    state store. Called before any stack is touched, so that a failure leaves no stacks behind that nothing polls
+    """
+    if shared_polling(event):
+        return
+    state = poll_state(event, context)
+    size = poll_state_size(state)
+    if size > POLL_INPUT_LIMIT and ('FanOut' not in state.keys() or not poll_state_store().durable):
+        raise Exception("Poll state is %s characters, over the EventBridge Input limit. Set POLL_STATE_TABLE so that "
+                        "fan-out state can be kept in DynamoDB, or use fewer targets" % size)
+
+
+def check_fanout_state(event, context, targets, stack_name):
+    """
+    check_poll_state for the fan-out state of stack_name in every target, with stack ids as long as the real ones
+    """
+    fanout = {}
+    for name, target in targets.items():
+        account = target['RoleArn'].split(":")[4] if target['RoleArn'] else context.invoked_function_arn.split(":")[4]
+        fanout[name] = dict(target, StackId='arn:aws:cloudformation:%s:%s:stack/%s/%s' % (
+            target['Region'], account, stack_name, '0' * STACK_ID_SUFFIX_LENGTH))
+    check_poll_state(dict(event, FanOut=fanout), context)
+
+
+def compact_poll_state(event, context):
+    """
+    Poll state for a rule's target Input. Fan-out state that would take it over the Input limit, such as a large
+    teardown, is moved to the state store and loaded by each poll, which needs a store that outlives the container
+    """
+    check_poll_state(event, context)
+    state = poll_state(event, context)
+    size = poll_state_size(state)
+    if size <= POLL_INPUT_LIMIT:
+        return state
+    state['PollStateKey'] = POLL_STATE_PREFIX + event['RequestId']
+    poll_state_store().put(state['PollStateKey'], {'FanOut': state.pop('FanOut')})
+    loga.info("Poll state is %s characters, fan-out state moved to %s" % (size, state['PollStateKey']))
+    return state
+
+
+def load_poll_state(event):
+    """
+    Check the version of a scheduled poll's state and load the fan-out state kept in the state store
+    """
+    if event['PollVersion'] > POLL_STATE_VERSION:
+        raise Exception("Poll state version %s is newer than the %s this function supports" % (
+            event['PollVersion'], POLL_STATE_VERSION))
+    if 'PollStateKey' in event.keys() and 'FanOut' not in event.keys():
+        record = poll_state_store().get(event['PollStateKey'])
+        if record is None:
+            raise Exception("Poll state %s not found in the state store" % event['PollStateKey'])
+        event['FanOut'] = record['FanOut']
 
 
 def remove_poll(event, context):
-    error = False
-    if 'rule' in event.keys():
-        remove_targets(event['rule'])
-    else:
-        loga.error("Cannot remove CloudWatch events rule, Rule arn not available in event")
-        error = True
-    if 'permission' in event.keys():
-        remove_permission(context, event['permission'])
-    else:
-        loga.error("Cannot remove lambda events permission, permission id not available in event")
-        error = True
-    if 'rule' in event.keys():
-        delete_rule(event['rule'])
-    else:
-        loga.error("Cannot remove CloudWatch events target, Rule arn not available in event")
-        error = True
-    if error:
-        raise Exception("failed to cleanup CloudWatch event polling")
+    """
+    Remove the poll rule, or the pending operation, before answering CloudFormation. A poll that runs past the next
+    tick overlaps with the following one, so whichever removes the permission (or the pending operation) first claims
+    the response. Returns False when an overlapping poll already has, the caller must not respond then
+    """
+    with rate_limit.limiter.essential():
+        if 'SharedPollKey' in event.keys():
+            return poll_state_store().claim(event['SharedPollKey'])
+        error = False
+        if 'permission' in event.keys():
+            if not remove_permission(context, event['permission']):
+                loga.warning("Poll rule was already removed by an overlapping poll, which answers CloudFormation")
+                return False
+        else:
+            loga.error("Cannot remove lambda events permission, permission id not available in event")
+            error = True
+        if 'rule' in event.keys():
+            remove_targets(event['rule'])
+            delete_rule(event['rule'])
+        else:
+            loga.error("Cannot remove CloudWatch events rule, Rule arn not available in event")
+            error = True
+        if 'PollStateKey' in event.keys():
+            poll_state_store().delete(event['PollStateKey'])
+        if error:
+            raise Exception("failed to cleanup CloudWatch event polling")
+        return True
 
 
-def create(event, context):
+def poll_state_store():
+    global state_store
+    if state_store is None:
+        state_store = get_state_store(local_client)
+    return state_store
+
+
+def ensure_shared_rule(context):
     """
-    Create a cfn stack using an assumed role
+    Create the shared poll rule and its target. The poller deletes the rule once nothing is pending, so both are put
+    for every registration. The invoke permission outlives the rule and is added once per container, all three calls
+    are idempotent
+    """
+    from botocore.exceptions import ClientError
+    global shared_rule_arn
+    rule_arn = local_client("events").put_rule(
+        Name=SHARED_POLL_RULE,
+        ScheduleExpression=SHARED_POLL_SCHEDULE,
+        State='ENABLED'
+    )["RuleArn"]
+    if shared_rule_arn != rule_arn:
+        try:
+            local_client("lambda").add_permission(
+                FunctionName=context.function_name,
+                StatementId=SHARED_POLL_RULE,
+                Action='lambda:InvokeFunction',
+                Principal='events.amazonaws.com',
+                SourceArn=rule_arn
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceConflictException':
+                raise
+    local_client("events").put_targets(
+        Rule=SHARED_POLL_RULE,
+        Targets=[{
+            'Id': '1',
+            'Arn': context.invoked_function_arn,
+            'Input': json.dumps({"SharedPoll": True})
+        }]
+    )
+    shared_rule_arn = rule_arn
+    return shared_rule_arn
+
+
+def remove_shared_rule(store, context):
+    """
+    Delete the shared poll rule, so an idle function is no longer invoked every tick. An operation registered while
+    the rule is deleted may have put it first, the store is read again afterwards and the rule put back if anything is
+    pending
+    """
+    from botocore.exceptions import ClientError
+    loga.info("Shared poll: nothing pending, removing rule %s" % SHARED_POLL_RULE)
+    try:
+        local_client("events").remove_targets(Rule=SHARED_POLL_RULE, Ids=['1'])
+        local_client("events").delete_rule(Name=SHARED_POLL_RULE)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            # a registration put the target back in between, the rule is needed
+            loga.warning("Keeping the shared poll rule: %s" % e)
+            return
+    if pending_operations(store):
+        ensure_shared_rule(context)
+
+
+def pending_operations(store):
+    return [(key, record) for key, record in store.list() if not key.startswith(POLL_STATE_PREFIX)]
+
+
+def function_region(context):
+    return context.invoked_function_arn.split(":")[3]
+
+
+def register_shared_poll(event, context):
+    """
+    Record the pending operation for the shared poller instead of creating a rule for this stack
+    """
+    event['SharedPollKey'] = event['RequestId']
+    record = poll_state(event, context)
+    record['Created'] = int(time.time())
+    poll_state_store().put(event['SharedPollKey'], record)
+    ensure_shared_rule(context)
+
+
+def describe_pending_stacks(cfn_client, stack_ids):
+    """
+    Return a dict of stack id to stack description. Larger batches are resolved by paging through all stacks in the
+    account/region, stacks missing from the listing (deleted stacks are not listed) are described individually
+    """
+    stacks = {}
+    if len(stack_ids) >= SHARED_POLL_LIST_THRESHOLD:
+        wanted = set(stack_ids)
+        for page in cfn_client.get_paginator('describe_stacks').paginate():
+            for stack in page['Stacks']:
+                if stack['StackId'] in wanted:
+                    stacks[stack['StackId']] = stack
+    for stack_id in stack_ids:
+        if stack_id not in stacks:
+            stacks[stack_id] = cfn_client.describe_stacks(StackName=stack_id)['Stacks'][0]
+    return stacks
+
+
+def shared_poll(event, context):
+    """
+    Shared poll tick, resolves every pending operation in the state store and answers the completed ones
+    """
+    store = poll_state_store()
+    pending = pending_operations(store)
+    if not pending:
+        remove_shared_rule(store, context)
+        return
+    groups = {}
+    for key, record in pending:
+        if 'FanOut' in record.keys():
+            shared_poll_fanout(store, key, record, context)
+            continue
+        groups.setdefault((record['RoleArn'], record['Region']), []).append((key, record))
+    loga.info("Shared poll: %s pending operations in %s account/regions" %
+              (sum(len(g) for g in groups.values()), len(groups)))
+    for (role_arn, region), records in groups.items():
+        if context.get_remaining_time_in_millis() / 1000.00 < INLINE_POLL_RESERVE:
+            loga.warning("Shared poll running out of time, remaining operations are left for the next tick")
+            break
+        if rate_limit.limiter.exhausted():
+            loga.warning("Shared poll used up its request budget, remaining operations are left for the next tick")
+            break
+        try:
+            cfn_client = cached_client("cloudformation", role_arn, region)
+            stacks = describe_pending_stacks(cfn_client, [r['PhysicalResourceId'] for _, r in records])
+        except rate_limit.RequestBudgetExceeded as e:
+            loga.warning("%s, remaining operations are left for the next tick" % e)
+            break
+        except Exception as e:
+            loga.error("Failed to describe stacks in %s using role %s" % (region, role_arn))
+            loga.error(e, exc_info=True)
+            expire_pending(store, records, context, e)
+            continue
+        for key, record in records:
+            response_data = {}
+            try:
+                stack = stacks[record['PhysicalResourceId']]
+                cursor = record.get('EventCursor')
+                if record.get('TailEvents') and 'PollStart' in record.keys():
+                    check_stack_events(cfn_client, stack, record, record['PollStart'])
+                response_data = stack_result(stack)
+                if "Complete" not in response_data.keys():
+                    if record.get('EventCursor') != cursor:
+                        store.put(key, record)
+                    continue
+                # an overlapping tick may have answered it already
+                if store.claim(key):
+                    send(record, context, "SUCCESS", cleanup_response(response_data), record['PhysicalResourceId'],
+                         logger=loga)
+            except rate_limit.RequestBudgetExceeded as e:
+                loga.warning("%s, %s is left for the next tick" % (e, key))
+            except Exception as e:
+                loga.error(e, exc_info=True)
+                if store.claim(key):
+                    send(record, context, "FAILED", cleanup_response(response_data), record['PhysicalResourceId'],
+                         reason=str(e), logger=loga)
+
+
+def shared_poll_fanout(store, key, record, context):
+    response_data = {}
+    if rate_limit.limiter.exhausted():
+        return
+    try:
+        cursors = json.dumps(record['FanOut'])
+        response_data = fanout_status(record)
+        if "Complete" not in response_data.keys():
+            if json.dumps(record['FanOut']) != cursors:
+                store.put(key, record)
+            return
+        if store.claim(key):
+            send(record, context, "SUCCESS", cleanup_response(response_data), record['PhysicalResourceId'],
+                 logger=loga)
+    except rate_limit.RequestBudgetExceeded as e:
+        loga.warning("%s, %s is left for the next tick" % (e, key))
+    except Exception as e:
+        loga.error(e, exc_info=True)
+        if store.claim(key):
+            send(record, context, "FAILED", cleanup_response(response_data), record['PhysicalResourceId'],
+                 reason=str(e), logger=loga)
+
+
+def expire_pending(store, records, context, error):
+    for key, record in records:
+        if time.time() - record['Created'] > SHARED_POLL_MAX_AGE and store.claim(key):
+            send(record, context, "FAILED", {}, record['PhysicalResourceId'], reason=str(error), logger=loga)
+
+
+def wait_for_stack(event, context):
+    """
+    Poll the stack from within this invocation with exponential backoff when InlinePoll is enabled, only
+    registering the scheduled poll if the stack is still in progress as the invocation nears its deadline
+    """
+    physical_resource_id = event["PhysicalResourceId"]
+    if is_enabled(event, 'InlinePoll', 'INLINE_POLL'):
+        delay = INLINE_POLL_MIN_DELAY
+        while context.get_remaining_time_in_millis() / 1000.00 - delay > INLINE_POLL_RESERVE and \
+                not rate_limit.limiter.exhausted():
+            time.sleep(delay)
+            physical_resource_id, response_data = poll(event, context)
+            if "Complete" in response_data.keys():
+                return physical_resource_id, response_data
+            delay = min(delay * 2, INLINE_POLL_MAX_DELAY)
+        loga.info("Stack operation still in progress, falling back to scheduled polling")
+    setup_poll(event, context)
+    return physical_resource_id, {}
+
+
+def parent_stack_properties(event):
+    """
+    Properties of the parent stack that its children inherit. All the children of a parent are created or updated
+    within seconds of each other, so a warm container describes the parent once and reuses it for PARENT_CACHE_TTL
+    """
+    parent_stack_id = event['ResourceProperties']['ParentStackId']
+    properties = parent_cache.get(parent_stack_id)
+    if properties is not None:
+        return properties
+    cfn_client = local_client("cloudformation")
+    prefix = parent_stack_id.split("/")[1]
+    stack = cfn_client.describe_stacks(StackName=prefix)['Stacks'][0]
+    properties = {k: stack[k] for k in PARENT_PROPERTIES if k in stack.keys()}
+    properties.setdefault('NotificationARNs', [])
+    properties.setdefault('RollbackConfiguration', {})
+    properties.setdefault('Tags', [])
+    if PARENT_CACHE_TTL > 0:
+        parent_cache.put(parent_stack_id, properties, time.time() + PARENT_CACHE_TTL)
+    return properties
+
+
+def s3_location(url):
+    """
+    Bucket and key of a virtual hosted or path style S3 url, None for other urls
+    """
+    url = urllib.parse.urlparse(url)
+    host = url.netloc.lower()
+    path = urllib.parse.unquote(url.path.lstrip('/'))
+    if host.startswith('s3.') or host.startswith('s3-'):
+        if '/' not in path:
+            return None
+        return tuple(path.split('/', 1))
+    for marker in ['.s3.', '.s3-']:
+        if marker in host and path:
+            return host.split(marker)[0], path
+    return None
+
+
+def template_etag(s3_client, template_url):
+    """
+    ETag of the template object, read with the role the stack is created with. None when it can't be read, the
+    summary is then fetched every time and the stack is always updated
+    """
+    location = s3_location(template_url)
+    if location is None:
+        return None
+    try:
+        return s3_client.head_object(Bucket=location[0], Key=location[1])['ETag']
+    except Exception as e:
+        loga.debug("cannot read the ETag of %s: %s" % (template_url, e))
+        return None
+
+
+def template_summary(cfn_client, template_url, etag):
     """
+    Parameter keys, with whether they have a default, and the capabilities required by a template
+    """
+    if etag is not None:
+        summary = template_summaries.get((template_url, etag))
+        if summary is not None:
+            return summary
+    response = cfn_client.get_template_summary(TemplateURL=template_url)
+    summary = {
+        'Parameters': {p['ParameterKey']: 'DefaultValue' in p.keys() for p in response.get('Parameters', [])},
+        'Capabilities': response.get('Capabilities', [])
+    }
+    if etag is not None:
+        template_summaries.put((template_url, etag), summary, time.time() + TEMPLATE_SUMMARY_TTL)
+    return summary
 
-    cfn_client = boto3.client("cloudformation")
-    params = get_cfn_parameters(event)
+
+def validate_template(cfn_client, event, capabilities, etag):
+    """
+    Fail before the stack operation when the template can't be read, or the resource's parameters or the inherited
+    capabilities don't match it, rather than after a round trip through the stack's rollback
+    """
+    from botocore.exceptions import ClientError
+    if not is_enabled(event, 'ValidateTemplate', 'VALIDATE_TEMPLATE', 'true'):
+        return
+    try:
+        summary = template_summary(cfn_client, event['ResourceProperties']['TemplateURL'], etag)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ValidationError':
+            loga.warning("Skipping template validation: %s" % e)
+            return
+        raise Exception("Invalid TemplateURL %s: %s" % (event['ResourceProperties']['TemplateURL'],
+                                                        e.response['Error'].get('Message', e)))
+    params = event['ResourceProperties'].get('CfnParameters', {})
+    errors = []
+    missing = sorted(k for k, has_default in summary['Parameters'].items() if not has_default and k not in params)
+    if missing:
+        errors.append("missing parameters %s" % ", ".join(missing))
+    unknown = sorted(k for k in params.keys() if k not in summary['Parameters'])
+    if unknown:
+        errors.append("parameters %s are not in the template" % ", ".join(unknown))
+    granted = set(capabilities)
+    # CAPABILITY_NAMED_IAM includes CAPABILITY_IAM
+    if 'CAPABILITY_NAMED_IAM' in granted:
+        granted.add('CAPABILITY_IAM')
+    required = sorted(c for c in summary['Capabilities'] if c not in granted)
+    if required:
+        errors.append("the template requires %s, which the parent stack was not given" % ", ".join(required))
+    if errors:
+        raise Exception("Template %s: %s" % (event['ResourceProperties']['TemplateURL'], "; ".join(errors)))
+
+
+def child_stack_name(event):
     prefix = event['ResourceProperties']['ParentStackId'].split("/")[1]
     suffix = "-" + event["LogicalResourceId"] + "-" + rand_string(13)
-    parent_properties = cfn_client.describe_stacks(StackName=prefix)['Stacks'][0]
-    cfn_client = get_client("cloudformation", event, context)
     prefix_length = len(prefix)
     suffix_length = len(suffix)
     if prefix_length + suffix_length > 128:
         prefix = prefix[:128-suffix_length]
-    stack_name = prefix + suffix
+    return prefix + suffix
+
+
+def stack_args(event, stack_name, parent_properties, etag):
+    """
+    Arguments of create_stack and update_stack, the child inherits the parent's properties on both
+    """
     capabilities = []
     if 'Capabilities' in parent_properties.keys():
         capabilities = parent_properties['Capabilities']
-    response = cfn_client.create_stack(
+    return dict(
         StackName=stack_name,
         TemplateURL=event['ResourceProperties']['TemplateURL'],
-        Parameters=params,
+        Parameters=get_cfn_parameters(event),
         Capabilities=capabilities,
         DisableRollback=parent_properties['DisableRollback'],
         NotificationARNs=parent_properties['NotificationARNs'],
@@ -330,46 +936,93 @@ def create(event, context):
         Tags=[{
             'Key': 'ParentStackId',
             'Value': event['ResourceProperties']['ParentStackId']
+        }, {
+            'Key': FINGERPRINT_TAG,
+            'Value': stack_fingerprint(event, etag)
         }] + parent_properties['Tags']
     )
-    physical_resource_id = response['StackId']
-    event["Poll"] = True
-    event["PhysicalResourceId"] = physical_resource_id
-    setup_poll(event, context)
-    return physical_resource_id, {}
 
 
-def update(event, context):
+def stack_fingerprint(event, etag):
     """
-    Update a cfn stack using an assumed role
+    Hash of what a stack is deployed from, the ETag stands in for the template content behind the URL
     """
-    stack_id = event["PhysicalResourceId"]
-    capabilities = []
-    if 'capabilities' in event['ResourceProperties'].keys():
-        capabilities = event['ResourceProperties']['capabilities']
-    cfn_client = get_client("cloudformation", event, context)
-    physical_resource_id = stack_id
-    prefix = event['ResourceProperties']['ParentStackId'].split("/")[1]
-    parent_properties = cfn_client.describe_stacks(StackName=prefix)['Stacks'][0]
-    if 'Capabilities' in parent_properties.keys():
-        capabilities = parent_properties['Capabilities']
+    props = event['ResourceProperties']
+    fingerprint = [props['TemplateURL'], etag, props.get('CfnParameters', {}), props.get('capabilities', [])]
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def update_child_stack(cfn_client, s3_client, stack_name, event, parent_properties):
+    """
+    Update a child stack unless it is already up to date. Returns the stack id, and the stack description when there
+    was nothing to update or None when an update was started. With SkipUnchanged enabled, a stack whose fingerprint
+    tag matches the resource properties and template is not updated at all, so no mutating calls are made
+    """
+    from botocore.exceptions import ClientError
+    etag = template_etag(s3_client, event['ResourceProperties']['TemplateURL'])
+    fingerprint = stack_fingerprint(event, etag)
+    # without the ETag a changed template can't be told apart
+    if etag is not None and is_enabled(event, 'SkipUnchanged', 'SKIP_UNCHANGED'):
+        stack = cfn_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        tags = {t['Key']: t['Value'] for t in stack.get('Tags', [])}
+        if tags.get(FINGERPRINT_TAG) == fingerprint and stack['StackStatus'] in cfn_states['success']:
+            return stack['StackId'], stack
+    args = stack_args(event, stack_name, parent_properties, etag)
+    if 'Capabilities' not in parent_properties.keys():
+        args['Capabilities'] = event['ResourceProperties'].get('capabilities', [])
+    validate_template(cfn_client, event, args['Capabilities'], etag)
     try:
-        cfn_client.update_stack(
-            StackName=stack_id,
-            TemplateURL=event['ResourceProperties']['TemplateURL'],
-            Parameters=get_cfn_parameters(event),
-            Capabilities=capabilities,
-            Tags=[{
-                'Key': 'ParentStackId',
-                'Value': event['ResourceProperties']['ParentStackId']
-            }]
-        )
+        response = cfn_client.update_stack(**args)
+        return response['StackId'], None
     except ClientError as e:
         if "No updates are to be performed" not in str(e):
             raise
-    event["Poll"] = True
-    setup_poll(event, context)
-    return physical_resource_id, {}
+    stack = cfn_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    return stack['StackId'], stack
+
+
+def create(event, context):
+    """
+    Create a cfn stack using an assumed role
+    """
+    if 'Targets' in event['ResourceProperties'].keys():
+        return fanout_create(event, context)
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
+    parent_properties = parent_stack_properties(event)
+    cfn_client = get_client("cloudformation", event, context)
+    etag = template_etag(get_client("s3", event, context), event['ResourceProperties']['TemplateURL'])
+    args = stack_args(event, child_stack_name(event), parent_properties, etag)
+    validate_template(cfn_client, event, args['Capabilities'], etag)
+    response = cfn_client.create_stack(**args)
+    event["PhysicalResourceId"] = response['StackId']
+    return wait_for_stack(event, context)
+
+
+def update(event, context):
+    """
+    Update a cfn stack using an assumed role
+    """
+    if replaces_resource(event):
+        return create(event, context)
+    if 'Targets' in event['ResourceProperties'].keys():
+        return fanout_update(event, context)
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
+    cfn_client = get_client("cloudformation", event, context)
+    stack_id, stack = update_child_stack(cfn_client, get_client("s3", event, context), event["PhysicalResourceId"],
+                                         event, parent_stack_properties(event))
+    if stack is None:
+        return wait_for_stack(event, context)
+    loga.info("Stack is already up to date, returning its current outputs")
+    return stack_id, stack_result(stack)
+
+
+def replaces_resource(event):
+    """
+    Whether an update switches between a single stack and fan-out, which replaces the resource. The stacks are
+    created from the new properties alone, CloudFormation deletes the old ones with the old properties
+    """
+    return event['RequestType'] == 'Update' and \
+        ('Targets' in event['ResourceProperties'].keys()) != ('Targets' in event['OldResourceProperties'].keys())
 
 
 def delete(event, context):
@@ -379,19 +1032,236 @@ def delete(event, context):
     stack_id = event["PhysicalResourceId"]
     if '[$LATEST]' in stack_id:
         # No stack was created, so exiting
-        return stack_id, {}
+        return stack_id, {'Complete': True}
+    if is_enabled(event, 'Teardown', 'TEARDOWN') and parent_deleting(event):
+        response = teardown_delete(event, context)
+        # None when the teardown can't be polled, the resource then deletes just its own stacks
+        if response is not None:
+            return response
+    if 'Targets' in event['ResourceProperties'].keys():
+        return fanout_delete(event, context)
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
     cfn_client = get_client("cloudformation", event, context)
     cfn_client.delete_stack(StackName=stack_id)
-    physical_resource_id = stack_id
-    event["Poll"] = True
-    setup_poll(event, context)
-    return physical_resource_id, {}
+    return wait_for_stack(event, context)
+
+
+def parent_deleting(event):
+    """
+    Whether the resource is being deleted because its parent stack is, rather than removed by a stack update
+    """
+    cfn_client = local_client("cloudformation")
+    parent = cfn_client.describe_stacks(StackName=event['ResourceProperties']['ParentStackId'])['Stacks'][0]
+    return parent['StackStatus'] == 'DELETE_IN_PROGRESS'
+
+
+def retained_resources(template):
+    """
+    Logical ids of the resources a template keeps when its stack is deleted. JSON templates are parsed, YAML ones are
+    scanned line by line as the Lambda runtime has no YAML parser. The scan reads block style resources, anything it
+    can't read, such as a resource written in flow style, counts as kept
+    """
+    if isinstance(template, str):
+        try:
+            template = json.loads(template)
+        except ValueError:
+            pass
+    if isinstance(template, dict):
+        return {name for name, resource in template.get('Resources', {}).items()
+                if not isinstance(resource, dict) or resource.get('DeletionPolicy', 'Delete') not in DELETED_POLICIES}
+    retained = set()
+    in_resources = False
+    resource_indent = attribute_indent = name = None
+    for line in template.splitlines():
+        text = line.split(' #')[0].rstrip()
+        if not text.strip() or text.lstrip().startswith('#'):
+            continue
+        indent = len(text) - len(text.lstrip())
+        key, _, value = text.strip().partition(':')
+        key, value = key.strip('\'"'), value.strip().strip('\'"')
+        if indent == 0:
+            in_resources = key == 'Resources'
+            continue
+        if not in_resources:
+            continue
+        if resource_indent is None or indent <= resource_indent:
+            resource_indent, attribute_indent, name = indent, None, key
+            if value:
+                retained.add(name)
+            continue
+        if attribute_indent is None:
+            attribute_indent = indent
+        if indent == attribute_indent and key == 'DeletionPolicy' and value not in DELETED_POLICIES:
+            retained.add(name)
+    return retained
+
+
+def teardown_owners(event):
+    """
+    Physical ids of the parent's resources that are deleted with it. Resources kept by their DeletionPolicy, or
+    skipped by CloudFormation, are left out
+    """
+    cfn_client = local_client("cloudformation")
+    parent_stack_id = event['ResourceProperties']['ParentStackId']
+    retained = retained_resources(cfn_client.get_template(
+        StackName=parent_stack_id, TemplateStage='Processed')['TemplateBody'])
+    owners = {event["PhysicalResourceId"]}
+    for page in cfn_client.get_paginator('list_stack_resources').paginate(StackName=parent_stack_id):
+        for resource in page['StackResourceSummaries']:
+            if resource['LogicalResourceId'] in retained or 'PhysicalResourceId' not in resource.keys() or \
+                    resource['ResourceStatus'] in ['DELETE_SKIPPED', 'DELETE_COMPLETE']:
+                continue
+            owners.add(resource['PhysicalResourceId'])
+    return owners
+
+
+def resource_targets(event, context):
+    """
+    Roles and regions the resource's stacks live in, named like fan-out targets
+    """
+    props = event['ResourceProperties']
+    if 'Targets' in props.keys():
+        return fanout_targets(props, context)
+    return fanout_targets({'Targets': [{'RoleArn': props.get('RoleArn'),
+                                        'Region': props.get('Region', function_region(context))}]}, context)
+
+
+def teardown_delete(event, context):
+    """
+    Delete every child stack of the parent in the resource's targets at once, found by their ParentStackId tag,
+    instead of leaving each one to be deleted in turn by its own resource. The stacks this invocation started
+    deleting, and the resource's own stacks, are then waited on together in a single fan-out poll. Only stacks of
+    resources that are deleted with the parent are included. Returns None, having deleted nothing, when the stacks
+    are too many to poll together
+    """
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
+    parent_stack_id = event['ResourceProperties']['ParentStackId']
+    stack_id = event["PhysicalResourceId"]
+    owners = teardown_owners(event)
+
+    def find_children(name, target):
+        cfn_client = cached_client("cloudformation", target['RoleArn'], target['Region'])
+        children = {}
+        for page in cfn_client.get_paginator('describe_stacks').paginate():
+            for stack in page['Stacks']:
+                tags = {t['Key']: t['Value'] for t in stack.get('Tags', [])}
+                # nested stacks inherit the tag and are deleted with their root
+                if tags.get('ParentStackId') != parent_stack_id or stack.get('ParentId') or \
+                        stack['StackStatus'] == 'DELETE_COMPLETE' or \
+                        (stack['StackId'] not in owners and stack['StackName'] not in owners):
+                    continue
+                children["%s/%s" % (name, stack['StackName'])] = dict(
+                    target, StackId=stack['StackId'], StackName=stack['StackName'], StackStatus=stack['StackStatus'])
+        return children
+
+    children = {}
+    targets = resource_targets(event, context)
+    for found in run_concurrently(find_children, targets, max_concurrency(event)).values():
+        children.update(found)
+    fanout = {name: {'RoleArn': child['RoleArn'], 'Region': child['Region'], 'StackId': child['StackId']}
+              for name, child in children.items()}
+    try:
+        check_poll_state(dict(event, FanOut=fanout), context)
+    except Exception as e:
+        loga.warning("Not tearing down %s child stacks: %s" % (len(children), e))
+        return None
+
+    def delete_child(name, child):
+        own = stack_id in [child['StackId'], child['StackName']]
+        if child['StackStatus'] == 'DELETE_IN_PROGRESS':
+            # another resource of the parent is already deleting it
+            return own
+        cfn_client = cached_client("cloudformation", child['RoleArn'], child['Region'])
+        cfn_client.delete_stack(StackName=child['StackId'])
+        return True
+
+    waiting = run_concurrently(delete_child, children, max_concurrency(event))
+    loga.info("Teardown of %s: %s child stacks found in %s targets, %s deleted by this resource" % (
+        parent_stack_id, len(children), len(targets), len([w for w in waiting.values() if w])))
+    event['FanOut'] = {name: state for name, state in fanout.items() if waiting[name]}
+    if not event['FanOut']:
+        return stack_id, {'Complete': True}
+    return wait_for_stack(event, context)
 
 
 def poll(event, context):
+    """
+    Check on the stack. Inline polls get the full request, scheduled polls the poll state from poll_state, or the full
+    request for rules created by earlier versions of the function
+    """
     stack_id = event["PhysicalResourceId"]
-    cfn_client = get_client("cloudformation", event, context)
+    if 'PollVersion' in event.keys():
+        load_poll_state(event)
+    if 'FanOut' in event.keys():
+        cursors = json.dumps(event['FanOut'])
+        response_data = fanout_status(event)
+        if 'PollStateKey' in event.keys() and "Complete" not in response_data.keys() and \
+                json.dumps(event['FanOut']) != cursors:
+            poll_state_store().put(event['PollStateKey'], {'FanOut': event['FanOut']})
+        return stack_id, response_data
+    if 'PollVersion' in event.keys():
+        cfn_client = cached_client("cloudformation", event['RoleArn'], event['Region'])
+        tail_events = event['TailEvents']
+    else:
+        cfn_client = get_client("cloudformation", event, context)
+        tail_events = is_enabled(event, 'TailEvents', 'TAIL_STACK_EVENTS', 'true')
     stack = cfn_client.describe_stacks(StackName=stack_id)['Stacks'][0]
+    # poll rules created before event tailing have no PollStart, and older failures would be mistaken for new ones
+    if tail_events and 'PollStart' in event.keys():
+        check_stack_events(cfn_client, stack, event, event['PollStart'])
+    return stack_id, stack_result(stack)
+
+
+def new_stack_events(cfn_client, stack_id, state, start):
+    """
+    Return the stack events written since the last call, oldest first. Paging stops at the newest event already
+    seen (tracked in the poll state and in the container) or at the first event older than start
+    """
+    cursor = event_cursors.get(stack_id) or state.get('EventCursor')
+    new_events = []
+    for page in cfn_client.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+        seen = False
+        for stack_event in page['StackEvents']:
+            if stack_event['EventId'] == cursor or stack_event['Timestamp'].timestamp() < start:
+                seen = True
+                break
+            new_events.append(stack_event)
+        if seen:
+            break
+    if new_events:
+        state['EventCursor'] = new_events[0]['EventId']
+        event_cursors.put(stack_id, new_events[0]['EventId'], time.time() + SHARED_POLL_MAX_AGE)
+    new_events.reverse()
+    return new_events
+
+
+def check_stack_events(cfn_client, stack, state, start):
+    """
+    Fail as soon as a resource in the stack reports a failure, rather than waiting for the rollback to finish. Roles
+    without cloudformation:DescribeStackEvents are left to the stack status
+    """
+    from botocore.exceptions import ClientError
+    if stack['StackStatus'] in cfn_states['success']:
+        return
+    try:
+        stack_events = new_stack_events(cfn_client, stack['StackId'], state, start)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['AccessDenied', 'AccessDeniedException']:
+            raise
+        loga.warning("Skipping stack events of %s, polling its status only: %s" % (stack['StackId'], e))
+        return
+    for stack_event in stack_events:
+        if stack_event['ResourceStatus'].endswith('_FAILED') and \
+                stack_event.get('PhysicalResourceId') != stack['StackId']:
+            raise Exception("Stack Failed: resource %s (%s) is %s: %s" % (
+                stack_event['LogicalResourceId'], stack_event.get('ResourceType', ''),
+                stack_event['ResourceStatus'], stack_event.get('ResourceStatusReason', '')))
+
+
+def stack_result(stack):
+    """
+    Raise if the stack failed, otherwise return its outputs with Complete set once it has finished
+    """
     response_data = {}
     if stack['StackStatus'] in cfn_states['failed']:
         error = "Stack launch failed, status is %s" % stack['StackStatus']
@@ -403,7 +1273,170 @@ def poll(event, context):
             for o in stack['Outputs']:
                 response_data[o['OutputKey']] = o['OutputValue']
         response_data['Complete'] = True
-    return stack_id, response_data
+    return response_data
+
+
+def max_concurrency(event):
+    return int(event.get('ResourceProperties', {}).get('MaxConcurrency', FANOUT_CONCURRENCY))
+
+
+def run_concurrently(func, items, concurrency):
+    """
+    Call func(key, item) for every entry of the items dict on a bounded thread pool, returning a dict of results.
+    All calls are allowed to finish before any failures are raised together
+    """
+    results = {}
+    errors = []
+    over_budget = False
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        futures = {key: executor.submit(func, key, item) for key, item in items.items()}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                loga.error("%s: %s" % (key, e))
+                errors.append("%s: %s" % (key, e))
+                over_budget = over_budget or isinstance(e, rate_limit.RequestBudgetExceeded)
+    if over_budget:
+        raise rate_limit.RequestBudgetExceeded("; ".join(errors))
+    if errors:
+        raise Exception("; ".join(errors))
+    return results
+
+
+def fanout_targets(props, context):
+    """
+    Return a dict of target name to role/region, targets are named after their account and region unless they
+    have a Name
+    """
+    targets = {}
+    for target in props['Targets']:
+        role_arn = target.get('RoleArn')
+        region = target.get('Region', function_region(context))
+        account = role_arn.split(":")[4] if role_arn else context.invoked_function_arn.split(":")[4]
+        name = target.get('Name', "%s-%s" % (account, region))
+        if name in targets:
+            raise Exception("Duplicate fan-out target %s" % name)
+        targets[name] = {'RoleArn': role_arn, 'Region': region}
+    return targets
+
+
+def fanout_create(event, context):
+    """
+    Create the same stack in every target. The stack name is shared by all targets and used as the physical id
+    """
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
+    parent_properties = parent_stack_properties(event)
+    stack_name = child_stack_name(event)
+    event["PhysicalResourceId"] = stack_name
+    targets = fanout_targets(event['ResourceProperties'], context)
+    check_fanout_state(event, context, targets, stack_name)
+
+    def launch(name, target):
+        cfn_client = cached_client("cloudformation", target['RoleArn'], target['Region'])
+        etag = template_etag(cached_client("s3", target['RoleArn'], target['Region']),
+                             event['ResourceProperties']['TemplateURL'])
+        args = stack_args(event, stack_name, parent_properties, etag)
+        validate_template(cfn_client, event, args['Capabilities'], etag)
+        return dict(target, StackId=cfn_client.create_stack(**args)['StackId'])
+
+    event['FanOut'] = run_concurrently(launch, targets, max_concurrency(event))
+    return wait_for_stack(event, context)
+
+
+def fanout_update(event, context):
+    """
+    Update the stack in every target, changing the list of targets replaces the resource
+    """
+    targets = fanout_targets(event['ResourceProperties'], context)
+    if targets != fanout_targets(event['OldResourceProperties'], context):
+        return fanout_create(event, context)
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
+    parent_properties = parent_stack_properties(event)
+    stack_name = event["PhysicalResourceId"]
+    check_fanout_state(event, context, targets, stack_name)
+
+    def update_target(name, target):
+        cfn_client = cached_client("cloudformation", target['RoleArn'], target['Region'])
+        s3_client = cached_client("s3", target['RoleArn'], target['Region'])
+        stack_id, stack = update_child_stack(cfn_client, s3_client, stack_name, event, parent_properties)
+        return dict(target, StackId=stack_id), stack
+
+    results = run_concurrently(update_target, targets, max_concurrency(event))
+    event['FanOut'] = {name: target for name, (target, _) in results.items()}
+    if any(stack is None for _, stack in results.values()):
+        return wait_for_stack(event, context)
+    loga.info("Stacks are already up to date, returning their current outputs")
+    return stack_name, fanout_response(event, {name: stack_result(stack) for name, (_, stack) in results.items()})
+
+
+def fanout_delete(event, context):
+    """
+    Delete the stack from every target, targets where it was never created are skipped
+    """
+    event["PollStart"] = time.time() - EVENT_CLOCK_SKEW
+    stack_name = event["PhysicalResourceId"]
+    targets = fanout_targets(event['ResourceProperties'], context)
+    check_fanout_state(event, context, targets, stack_name)
+
+    def delete_target(name, target):
+        from botocore.exceptions import ClientError
+        cfn_client = cached_client("cloudformation", target['RoleArn'], target['Region'])
+        try:
+            stack_id = cfn_client.describe_stacks(StackName=stack_name)['Stacks'][0]['StackId']
+        except ClientError as e:
+            if "does not exist" not in str(e):
+                raise
+            return None
+        cfn_client.delete_stack(StackName=stack_id)
+        return dict(target, StackId=stack_id)
+
+    deleted = run_concurrently(delete_target, targets, max_concurrency(event))
+    event['FanOut'] = {name: target for name, target in deleted.items() if target}
+    return wait_for_stack(event, context)
+
+
+def fanout_status(event):
+    """
+    Describe every fan-out stack, failing if any of them failed and returning the outputs of all targets, keyed
+    <target>.<OutputKey>, once they are all complete
+    """
+    if 'TailEvents' in event.keys():
+        tail_events = event['TailEvents']
+    else:
+        tail_events = is_enabled(event, 'TailEvents', 'TAIL_STACK_EVENTS', 'true')
+
+    def describe_target(name, target):
+        cfn_client = cached_client("cloudformation", target['RoleArn'], target['Region'])
+        stack = cfn_client.describe_stacks(StackName=target['StackId'])['Stacks'][0]
+        if tail_events and 'PollStart' in event.keys():
+            check_stack_events(cfn_client, stack, target, event['PollStart'])
+        return stack_result(stack)
+
+    concurrency = event.get('MaxConcurrency') or max_concurrency(event)
+    return fanout_response(event, run_concurrently(describe_target, event['FanOut'], concurrency))
+
+
+def fanout_response(event, results):
+    if any("Complete" not in result.keys() for result in results.values()):
+        return {}
+    if event.get('RequestType') == 'Delete':
+        # nothing reads the attributes of a deleted resource, and a teardown can wait on many stacks
+        return {'Complete': True}
+    if 'StackIdOutputs' in event.keys():
+        stack_ids = event['StackIdOutputs']
+    else:
+        stack_ids = is_enabled(event, 'StackIdOutputs', 'STACK_ID_OUTPUTS')
+    response_data = {}
+    for name, result in results.items():
+        del result['Complete']
+        # the stack ids are opt in, custom resource responses are limited to 4096 bytes
+        if stack_ids:
+            response_data["%s.StackId" % name] = event['FanOut'][name]['StackId']
+        for output_key, output_value in result.items():
+            response_data["%s.%s" % (name, output_key)] = output_value
+    response_data['Complete'] = True
+    return response_data
 
 
 def get_client(service, event, context):
@@ -413,7 +1446,7 @@ def get_client(service, event, context):
     region = context.invoked_function_arn.split(":")[3]
     if "Region" in event["ResourceProperties"].keys():
         region = event["ResourceProperties"]["Region"]
-    if event['RequestType'] == 'Update':
+    if event['RequestType'] == 'Update' and not replaces_resource(event):
         old_role = None
         if 'RoleArn' in event['OldResourceProperties'].keys():
             old_role = event['OldResourceProperties']['RoleArn']
@@ -424,26 +1457,62 @@ def get_client(service, event, context):
             old_region = event['OldResourceProperties']['Region']
         if region != old_region:
             raise Exception("Changing the region for stack updates is not supported")
-    if role_arn:
-        sess = assume_role(Session(), role_arn, session_name="QuickStartCfnStack")
-        client = sess.create_client(service, region_name=region)
-    else:
-        client = boto3.client(service, region_name=region)
-    return client
+    return cached_client(service, role_arn, region)
+
+
+def cached_client(service, role_arn, region):
+    """
+    Return a client for service/region, using role_arn if provided. Clients and assumed role sessions are reused
+    by warm containers until shortly before the assumed role credentials expire. Called from the fan-out worker
+    threads, so clients are created under a lock: boto3's default session and botocore sessions aren't thread safe
+    """
+    with client_lock:
+        key = (role_arn, region, service)
+        client = client_cache.get(key)
+        if client is not None:
+            return client
+        if role_arn:
+            cached = session_cache.get(role_arn)
+            if cached is None:
+                expires_at = time.time() + ASSUME_ROLE_DURATION
+                from botocore.session import Session
+                source_session = Session()
+                # the STS client used for AssumeRole is created from this session
+                metrics.recorder.instrument(source_session)
+                sess = assume_role(source_session, role_arn, duration=ASSUME_ROLE_DURATION,
+                                   session_name="QuickStartCfnStack")
+                session_cache.put(role_arn, (sess, expires_at), expires_at)
+            else:
+                sess, expires_at = cached
+            client = sess.create_client(service, region_name=region)
+        else:
+            import boto3
+            expires_at = float('inf')
+            client = boto3.client(service, region_name=region)
+        metrics.recorder.instrument(client.meta.events)
+        rate_limit.limiter.instrument(client.meta.events, service, key)
+        client_cache.put(key, client, expires_at)
+        return client
+
 
+def local_client(service):
+    """
+    Client in the function's own account and region. Created on first use rather than at import so that invocations
+    which never call the service don't pay for it. A failure fails only the request that hit it, through the
+    handler's usual FAILED response, and a later request creates the client again
+    """
+    try:
+        return cached_client(service, None, None)
+    except Exception as err:
+        loga.error("Failed to create %s client: %s" % (service, err))
+        raise
 
-# initialise logger
-loga = log_config({"RequestId": "CONTAINER_INIT"})
-loga.info('Logging configured')
-# set global to track init failures
-init_fail = False
 
-try:
-    lambda_client = boto3.client("lambda")
-    events_client = boto3.client("events")
-except Exception as err:
-    loga.error(str(err))
-    init_fail = err
+# logger until the handler configures logging for the request
+loga = logging.LoggerAdapter(logging.getLogger(), {'requestid': 'CONTAINER_INIT'})
+# pending operation store and shared rule, created on first use
+state_store = None
+shared_rule_arn = None
 
 
 def lambda_handler(event, context):
@@ -453,5 +1522,21 @@ def lambda_handler(event, context):
     # update the logger with event info
     global loga
     print(json.dumps(event))
-    loga = log_config(event)
-    return cfn_handler(event, context, create, update, delete, loga, init_fail)
+    metrics.recorder.reset()
+    rate_limit.limiter.reset()
+    polling = scheduled_poll(event)
+    try:
+        if event.get('SharedPoll'):
+            loga = log_config({"RequestId": context.aws_request_id})
+            return shared_poll(event, context)
+        loga = log_config(event)
+        return cfn_handler(event, context, create, update, delete, loga)
+    finally:
+        loga.debug("client cache: %s session cache: %s parent cache: %s template summaries: %s" % (
+            json.dumps(client_cache.stats()), json.dumps(session_cache.stats()), json.dumps(parent_cache.stats()),
+            json.dumps(template_summaries.stats())))
+        metrics.recorder.emit({'FunctionName': context.function_name}, {
+            'RequestType': 'SharedPoll' if event.get('SharedPoll') else event.get('RequestType'),
+            'Poll': polling,
+            'RequestId': event.get('RequestId', context.aws_request_id)
+        }, rate_limit.limiter.stats() if rate_limit.limiter.enabled else None)
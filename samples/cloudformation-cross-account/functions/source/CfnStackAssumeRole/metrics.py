@@ -0,0 +1,115 @@
+"""
+Per invocation AWS API call metrics. Durations, retries and error codes are collected with botocore event hooks and
+written to stdout as a single CloudWatch embedded metric format record per invocation. Set API_METRICS to false to
+switch collection off completely, no hooks are registered in that case.
+"""
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('API_METRICS', 'true').lower() in ['true', 'yes', '1']
+NAMESPACE = os.environ.get('API_METRICS_NAMESPACE', 'QuickStart/CfnStackAssumeRole')
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown']
+
+
+class ApiCallRecorder(object):
+
+    def __init__(self, enabled=ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.started = time.time()
+
+    def instrument(self, emitter):
+        """
+        Register the hooks on a client's meta.events, or on a botocore session so that clients it creates later,
+        such as the STS client used for AssumeRole, are instrumented too
+        """
+        if not self.enabled:
+            return
+        emitter.register('before-call', self._before_call)
+        emitter.register('after-call', self._after_call)
+        emitter.register('after-call-error', self._after_call_error)
+
+    def record(self, service, operation, duration, retries=0, error_code=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            call = self.calls.setdefault((service, operation), {
+                'Count': 0, 'Duration': 0.0, 'MaxDuration': 0.0, 'Retries': 0, 'Errors': 0, 'Throttles': 0
+            })
+            call['Count'] += 1
+            call['Duration'] += duration
+            call['MaxDuration'] = max(call['MaxDuration'], duration)
+            call['Retries'] += retries
+            if error_code:
+                call['Errors'] += 1
+                if error_code in THROTTLE_CODES:
+                    call['Throttles'] += 1
+
+    def _before_call(self, model, context, **kwargs):
+        context['api_metrics'] = (model.service_model.service_name, model.name, time.time())
+
+    def _after_call(self, parsed, context, **kwargs):
+        if 'api_metrics' not in context:
+            return
+        service, operation, start = context.pop('api_metrics')
+        metadata = parsed.get('ResponseMetadata', {})
+        self.record(service, operation, (time.time() - start) * 1000, metadata.get('RetryAttempts', 0),
+                    parsed.get('Error', {}).get('Code'))
+
+    def _after_call_error(self, exception, context, **kwargs):
+        if 'api_metrics' not in context:
+            return
+        service, operation, start = context.pop('api_metrics')
+        self.record(service, operation, (time.time() - start) * 1000, error_code=type(exception).__name__)
+
+    def emit(self, dimensions, properties=None, extra_metrics=None):
+        """
+        Print the metrics recorded since the last reset as one embedded metric format record. extra_metrics adds
+        metrics recorded elsewhere, as name: (value, unit)
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            calls = dict(self.calls)
+        record = dict(dimensions)
+        record.update(properties or {})
+        metrics = []
+
+        def add(name, value, unit):
+            record[name] = value
+            metrics.append({'Name': name, 'Unit': unit})
+
+        for (service, operation), call in sorted(calls.items()):
+            prefix = "%s.%s." % (service, operation)
+            add(prefix + 'Calls', call['Count'], 'Count')
+            add(prefix + 'Duration', round(call['Duration'], 2), 'Milliseconds')
+            add(prefix + 'MaxDuration', round(call['MaxDuration'], 2), 'Milliseconds')
+            add(prefix + 'Retries', call['Retries'], 'Count')
+            add(prefix + 'Errors', call['Errors'], 'Count')
+        add('ApiCalls', sum(c['Count'] for c in calls.values()), 'Count')
+        add('ApiDuration', round(sum(c['Duration'] for c in calls.values()), 2), 'Milliseconds')
+        add('Retries', sum(c['Retries'] for c in calls.values()), 'Count')
+        add('Throttles', sum(c['Throttles'] for c in calls.values()), 'Count')
+        add('InvocationDuration', round((time.time() - self.started) * 1000, 2), 'Milliseconds')
+        for name, (value, unit) in sorted((extra_metrics or {}).items()):
+            add(name, value, unit)
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': metrics
+            }]
+        }
+        print(json.dumps(record))
+
+
+recorder = ApiCallRecorder()
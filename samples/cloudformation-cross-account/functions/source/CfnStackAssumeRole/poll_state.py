@@ -0,0 +1,178 @@
+"""
+Backends for the store of pending stack operations used by the shared poller, which also holds fan-out state too
+large for a poll rule's Input. Records are small json serialisable dicts keyed by a string, the backend is selected
+from the function's environment by get_state_store()
+"""
+import json
+import os
+import threading
+
+
+class StateStore(object):
+    # whether records outlive the container, only durable stores can hold state for polls run by other containers
+    durable = True
+
+    def put(self, key, record):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def claim(self, key):
+        """
+        Delete the record, returning False if it was already gone. Only one of several concurrent claims of a record
+        succeeds, the shared poller claims an operation before answering it so overlapping ticks answer it once
+        """
+        raise NotImplementedError
+
+    def list(self):
+        """
+        Return a list of (key, record) tuples for all pending operations
+        """
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """
+    Stand-in backend for local testing, state is lost when the container is recycled
+    """
+    durable = False
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, record):
+        with self._lock:
+            self._records[key] = json.loads(json.dumps(record))
+
+    def get(self, key):
+        with self._lock:
+            return self._records.get(key)
+
+    def delete(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+
+    def claim(self, key):
+        with self._lock:
+            return self._records.pop(key, None) is not None
+
+    def list(self):
+        with self._lock:
+            return list(self._records.items())
+
+
+class FileStateStore(StateStore):
+    """
+    Keeps all records in a single json file, for local runs and single container use
+    """
+    # the file lives in one container's /tmp, other containers don't see it
+    durable = False
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, records):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(records, f)
+        os.replace(tmp_path, self.path)
+
+    def put(self, key, record):
+        with self._lock:
+            records = self._read()
+            records[key] = record
+            self._write(records)
+
+    def get(self, key):
+        with self._lock:
+            return self._read().get(key)
+
+    def delete(self, key):
+        with self._lock:
+            records = self._read()
+            if records.pop(key, None) is not None:
+                self._write(records)
+
+    def claim(self, key):
+        with self._lock:
+            records = self._read()
+            if records.pop(key, None) is None:
+                return False
+            self._write(records)
+            return True
+
+    def list(self):
+        with self._lock:
+            return list(self._read().items())
+
+
+class DynamoDBStateStore(StateStore):
+    """
+    One item per pending operation in a table with a string partition key named "Key"
+    """
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        if client is None:
+            import boto3
+            client = boto3.client('dynamodb')
+        self.client = client
+
+    def put(self, key, record):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={'Key': {'S': key}, 'Record': {'S': json.dumps(record)}}
+        )
+
+    def get(self, key):
+        response = self.client.get_item(TableName=self.table_name, Key={'Key': {'S': key}}, ConsistentRead=True)
+        if 'Item' not in response:
+            return None
+        return json.loads(response['Item']['Record']['S'])
+
+    def delete(self, key):
+        self.client.delete_item(TableName=self.table_name, Key={'Key': {'S': key}})
+
+    def claim(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.delete_item(TableName=self.table_name, Key={'Key': {'S': key}},
+                                    ConditionExpression='attribute_exists(#key)',
+                                    ExpressionAttributeNames={'#key': 'Key'})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    def list(self):
+        records = []
+        for page in self.client.get_paginator('scan').paginate(TableName=self.table_name, ConsistentRead=True):
+            for item in page['Items']:
+                records.append((item['Key']['S'], json.loads(item['Record']['S'])))
+        return records
+
+
+def get_state_store(client_factory=None):
+    """
+    Select a backend from the POLL_STATE_TABLE or POLL_STATE_FILE environment variables, falling back to memory.
+    client_factory(service) creates the DynamoDB client, boto3.client is used if it is not given
+    """
+    if os.environ.get('POLL_STATE_TABLE'):
+        client = client_factory('dynamodb') if client_factory else None
+        return DynamoDBStateStore(os.environ['POLL_STATE_TABLE'], client)
+    if os.environ.get('POLL_STATE_FILE'):
+        return FileStateStore(os.environ['POLL_STATE_FILE'])
+    return MemoryStateStore()
@@ -0,0 +1,184 @@
+"""
+Client side rate limiting of AWS API calls. Every request attempt takes a token from a bucket shared by all clients
+for the same role, region and service in the container. Throttled attempts halve the bucket's rate and successful
+calls let it recover, so a burst of resources backs off together instead of retrying into the throttle. A per
+invocation request budget caps the attempts a single invocation can make, less a reserve that only the calls registering and removing polls may use. It is opt-in, set RATE_LIMIT to true to
+switch it on, no hooks are registered otherwise.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from metrics import THROTTLE_CODES
+
+ENABLED = os.environ.get('RATE_LIMIT', 'false').lower() in ['true', 'yes', '1']
+# Requests per second for each service, as service:rate pairs, services that aren't listed are not rate limited
+RATE_LIMITS = {service.strip(): float(rate) for service, rate in (
+    pair.split(':') for pair in os.environ.get('RATE_LIMITS', 'cloudformation:10,events:10,lambda:10').split(',')
+    if pair.strip())}
+# Lowest rate a throttled bucket backs off to, as a fraction of its configured rate
+RATE_LIMIT_MIN_FRACTION = float(os.environ.get('RATE_LIMIT_MIN_FRACTION', 0.1))
+# Longest a request waits for a token, after that it is sent anyway and left to botocore's retries. Keep it well under
+# the poll interval, a poll that runs past the next tick of its rule overlaps the following one
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 2))
+# Request attempts allowed per invocation, 0 for no limit
+REQUEST_BUDGET = int(os.environ.get('REQUEST_BUDGET', 0))
+# Requests kept back from the budget for registering and removing polls. Other calls are refused once only the reserve
+# is left, calls made in RateLimiter.essential() never are, so a request can always clean up and answer CloudFormation
+REQUEST_BUDGET_RESERVE = int(os.environ.get('REQUEST_BUDGET_RESERVE', 10))
+
+
+class RequestBudgetExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """
+    Token bucket whose rate adapts to throttling. A request reserves a token straight away and sleeps until it is due,
+    so concurrent threads queue up in order rather than polling the bucket
+    """
+
+    def __init__(self, rate, min_fraction=RATE_LIMIT_MIN_FRACTION):
+        self.max_rate = rate
+        self.min_rate = rate * min_fraction
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        Take a token, returns the seconds waited for it
+        """
+        with self._lock:
+            now = time.monotonic()
+            # the debt is capped at max_wait, requests past it don't push the queue out any further
+            self.tokens = max(-max_wait * self.rate,
+                              min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1)
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter(object):
+
+    def __init__(self, enabled=ENABLED, limits=None, budget=REQUEST_BUDGET, reserve=REQUEST_BUDGET_RESERVE):
+        self.enabled = enabled
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.budget = budget
+        # a budget too small to hold the reserve is left whole for the other calls
+        self.reserve = reserve if budget > reserve else 0
+        self.buckets = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new invocation, the buckets are kept so their rates carry over between invocations of a container
+        """
+        with self._lock:
+            self.requests = 0
+            self.throttles = {}
+            self.waited = 0.0
+
+    def bucket(self, key, service):
+        with self._lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.limits[service])
+            return self.buckets[key]
+
+    def instrument(self, emitter, service, key):
+        """
+        Register the hooks on a client's meta.events. key identifies the bucket, clients for the same role, region
+        and service should share one
+        """
+        if not self.enabled:
+            return
+        bucket = self.bucket(key, service) if service in self.limits else None
+        emitter.register('before-send', lambda **kwargs: self._before_send(bucket))
+        emitter.register('needs-retry', lambda **kwargs: self._needs_retry(bucket, service, **kwargs))
+        emitter.register('after-call', lambda **kwargs: self._after_call(bucket, **kwargs))
+
+    def remaining(self):
+        """
+        Request attempts left in this invocation's budget, None when there is no budget
+        """
+        if not self.enabled or not self.budget:
+            return None
+        with self._lock:
+            return self.budget - self.requests
+
+    def exhausted(self):
+        """
+        Whether only the reserve is left, calls outside essential() would be refused
+        """
+        remaining = self.remaining()
+        return remaining is not None and remaining <= self.reserve
+
+    @contextmanager
+    def essential(self):
+        """
+        Calls the thread makes in the block are counted but never refused, for registering and removing polls
+        """
+        previous = getattr(self._local, 'essential', False)
+        self._local.essential = True
+        try:
+            yield
+        finally:
+            self._local.essential = previous
+
+    def _before_send(self, bucket, **kwargs):
+        essential = getattr(self._local, 'essential', False)
+        with self._lock:
+            self.requests += 1
+            over = self.budget and not essential and self.requests > self.budget - self.reserve
+        if over:
+            raise RequestBudgetExceeded("Request budget of %s API calls for this invocation exceeded, %s are kept "
+                                        "back for polls" % (self.budget, self.reserve))
+        if bucket:
+            waited = bucket.acquire()
+            if waited:
+                with self._lock:
+                    self.waited += waited
+
+    def _needs_retry(self, bucket, service, response=None, **kwargs):
+        if not response or response[1].get('Error', {}).get('Code') not in THROTTLE_CODES:
+            return
+        with self._lock:
+            self.throttles[service] = self.throttles.get(service, 0) + 1
+        if bucket:
+            bucket.throttled()
+
+    def _after_call(self, bucket, parsed=None, **kwargs):
+        if bucket and (parsed or {}).get('Error', {}).get('Code') not in THROTTLE_CODES:
+            bucket.succeeded()
+
+    def stats(self):
+        """
+        Metrics of the current invocation as name: (value, unit)
+        """
+        with self._lock:
+            stats = {
+                'RequestAttempts': (self.requests, 'Count'),
+                'ThrottledAttempts': (sum(self.throttles.values()), 'Count'),
+                'RateLimitWait': (round(self.waited * 1000, 2), 'Milliseconds')
+            }
+            for service, count in sorted(self.throttles.items()):
+                stats['%s.ThrottledAttempts' % service] = (count, 'Count')
+            return stats
+
+
+limiter = RateLimiter()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Cold start benchmark for the CfnStackAssumeRole function. Every run imports the handler in a fresh interpreter and
+invokes it once with stubbed AWS clients, reporting the import time and the latency of the first invocation.
+
+    python scripts/benchmark_cold_start.py --runs 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'source',
+                          'CfnStackAssumeRole')
+SCENARIOS = ['delete-never-created', 'poll-complete', 'poll-in-progress']
+
+
+class Context(object):
+    function_name = 'CfnStackAssumeRole'
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:111111111111:function:CfnStackAssumeRole'
+    log_stream_name = '2020/01/01/[$LATEST]0123456789abcdef'
+    aws_request_id = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class StubClient(object):
+    """
+    Stands in for every client, the CloudFormation calls of a poll and the calls that remove its rule
+    """
+
+    def __init__(self, status):
+        self.status = status
+
+    def describe_stacks(self, StackName):
+        return {'Stacks': [{'StackId': StackName, 'StackStatus': self.status,
+                            'Outputs': [{'OutputKey': 'BucketName', 'OutputValue': 'example'}]}]}
+
+    def remove_permission(self, **kwargs):
+        return {}
+
+    def remove_targets(self, **kwargs):
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    def delete_rule(self, **kwargs):
+        return {}
+
+
+class ResponseHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    statuses = []
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.statuses.append(json.loads(body.decode('utf-8')).get('Status'))
+        self.send_response(200)
+        self.send_header('content-length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def event_for(scenario, response_url):
+    event = {
+        'RequestType': 'Create',
+        'ResponseURL': response_url,
+        'StackId': 'arn:aws:cloudformation:us-east-1:111111111111:stack/parent/guid',
+        'RequestId': 'request',
+        'LogicalResourceId': 'DevStack',
+        'ResourceProperties': {
+            'ParentStackId': 'arn:aws:cloudformation:us-east-1:111111111111:stack/parent/guid',
+            'TemplateURL': 'https://example.com/template.yaml',
+            'CfnParameters': {},
+            'TailEvents': 'false'
+        }
+    }
+    if scenario == 'delete-never-created':
+        event['RequestType'] = 'Delete'
+        event['PhysicalResourceId'] = Context.log_stream_name
+    else:
+        # the Input of a poll rule created by an earlier version of the function, the request with its rule
+        event['Poll'] = True
+        event['rule'] = 'arn:aws:events:us-east-1:111111111111:rule/QuickStartStackMaker-benchmark'
+        event['permission'] = 'QuickStartStackMaker-benchmark'
+        event['PollStart'] = 0
+        event['PhysicalResourceId'] = 'arn:aws:cloudformation:us-east-1:111111111111:stack/child/guid'
+    return event
+
+
+def child(scenario):
+    """
+    Runs in a fresh interpreter, prints the timings as json
+    """
+    server = HTTPServer(('127.0.0.1', 0), ResponseHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sys.path.insert(0, SOURCE_DIR)
+
+    start = time.perf_counter()
+    import lambda_function
+    imported = time.perf_counter()
+
+    status = 'CREATE_COMPLETE' if scenario == 'poll-complete' else 'CREATE_IN_PROGRESS'
+    lambda_function.cached_client = lambda service, role_arn, region: StubClient(status)
+    lambda_function.logging.disable(lambda_function.logging.CRITICAL)
+    event = event_for(scenario, 'http://127.0.0.1:%s/response?signature=x' % server.server_port)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        lambda_function.lambda_handler(event, Context())
+    finally:
+        sys.stdout = stdout
+    invoked = time.perf_counter()
+    print(json.dumps({
+        'import': (imported - start) * 1000,
+        'invoke': (invoked - imported) * 1000,
+        'boto3_loaded': 'boto3' in sys.modules,
+        'responses': ResponseHandler.statuses
+    }))
+
+
+def summarise(name, values):
+    values = sorted(values)
+    p90 = values[min(len(values) - 1, int(len(values) * 0.9))]
+    return "%-10s min %8.2fms  median %8.2fms  p90 %8.2fms" % (name, values[0], statistics.median(values), p90)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", default=10, type=int, help="Number of cold starts per scenario")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="Scenario to run, defaults to all")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+    for scenario in args.scenario or SCENARIOS:
+        results = []
+        for _ in range(args.runs):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', scenario])
+            results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        print(scenario)
+        print("  " + summarise('import', [r['import'] for r in results]))
+        print("  " + summarise('invoke', [r['invoke'] for r in results]))
+        print("  boto3 imported: %s" % any(r['boto3_loaded'] for r in results))
+        print("  responses: %s" % (", ".join(sorted(set(s for r in results for s in r['responses']))) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
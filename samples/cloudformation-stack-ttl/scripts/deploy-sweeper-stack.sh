@@ -0,0 +1,6 @@
+#! /bin/bash
+
+aws cloudformation create-stack --region us-east-1 --stack-name cfn-stack-ttl-sweeper \
+  --template-url https://s3.amazonaws.com/aws-quickstart/quickstart-examples/samples/cloudformation-stack-ttl/templates/cloudformation-stack-ttl-sweeper.yaml \
+  --capabilities "CAPABILITY_IAM" \
+  --parameters ParameterKey=DryRun,ParameterValue=true
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+"""
+Offline lifecycle simulator and load benchmark for the custom resource Lambdas in this repository. Replays
+Create -> Poll... -> Update -> Delete for many resources concurrently against the real handler code, with stubbed
+AWS services and a local http server standing in for the pre-signed CloudFormation response url, then reports
+per-phase latency percentiles, API call counts and whether every request got exactly one well formed response.
+
+    python simulator.py --function cross-account --resources 50 --latency 0.05 --throttle-rate 0.02
+    python simulator.py --function codebuild --resources 20 --images 250
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stubs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLES = os.path.join(HERE, '..')
+PHASES = ['Create', 'Update', 'Delete']
+PHASE_COMPLETE = {'Create': 'CREATE_COMPLETE', 'Update': 'UPDATE_COMPLETE', 'Delete': 'DELETE_COMPLETE'}
+
+
+class ResponseServer(object):
+    """
+    Records the responses PUT to the local response urls, one url per resource and request
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.condition = threading.Condition()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers['content-length']))
+                with server.condition:
+                    server.responses.setdefault(self.path.split('?')[0], []).append((time.time(), body))
+                    server.condition.notify_all()
+                self.send_response(200)
+                self.send_header('content-length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s?X-Amz-Signature=simulated' % (self.httpd.server_port, path)
+
+    def wait(self, path, timeout):
+        """
+        Return (received time, parsed body) of the first response to path, or None on timeout
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while path not in self.responses:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            received, body = self.responses[path][0]
+        try:
+            return received, json.loads(body)
+        except ValueError:
+            return received, {'Malformed': body.decode('utf-8', 'replace')}
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+class Context(object):
+
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.invoked_function_arn = 'arn:aws:lambda:%s:%s:function:%s' % (stubs.FUNCTION_REGION,
+                                                                          stubs.FUNCTION_ACCOUNT, function_name)
+        self.log_stream_name = '2020/01/01/[$LATEST]%s' % uuid.uuid4().hex
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+class CrossAccountFunction(object):
+    name = 'CfnStackAssumeRole'
+    source = os.path.join(SAMPLES, 'cloudformation-cross-account', 'functions', 'source', 'CfnStackAssumeRole')
+
+    def __init__(self, args, world):
+        self.args = args
+        self.world = world
+        environment = {'INLINE_POLL_MIN_DELAY': '0.2', 'INLINE_POLL_MAX_DELAY': '2', 'INLINE_POLL_RESERVE': '1',
+                       'POLL_STATE_TABLE': 'sim-poll-state'}
+        if args.poll_mode == 'inline':
+            environment['INLINE_POLL'] = 'true'
+        elif args.poll_mode == 'shared':
+            environment['POLL_MODE'] = 'shared'
+        if args.teardown:
+            environment['TEARDOWN'] = 'true'
+        for k, v in environment.items():
+            os.environ.setdefault(k, v)
+        sys.path.insert(0, self.source)
+        import lambda_function
+        self.module = lambda_function
+
+    def handler(self, event, context):
+        return self.module.lambda_handler(event, context)
+
+    def properties(self, index, version, parent_stack_id):
+        props = {
+            'ServiceToken': 'arn:aws:lambda:%s:%s:function:%s' % (stubs.FUNCTION_REGION, stubs.FUNCTION_ACCOUNT,
+                                                                  self.name),
+            'ParentStackId': parent_stack_id,
+            'TemplateURL': 'https://quickstart-simulated.s3.amazonaws.com/templates/child.yaml',
+            'CfnParameters': {'Index': str(index), 'Version': str(version)}
+        }
+        # the update switches to --update-targets, the delete keeps the properties of the update
+        targets = self.args.targets if version == 0 or self.args.update_targets is None else self.args.update_targets
+        if targets:
+            props['Targets'] = [{'RoleArn': 'arn:aws:iam::%012d:role/simulated' % (222222222222 + t),
+                                 'Region': 'us-west-2'} for t in range(targets)]
+        else:
+            props['RoleArn'] = 'arn:aws:iam::222222222222:role/simulated'
+            props['Region'] = 'us-west-2'
+        return props
+
+    def check(self, phase, body):
+        problems = []
+        if body.get('Status') == 'SUCCESS' and phase != 'Delete' and not body.get('Data'):
+            problems.append('no outputs returned')
+        return problems
+
+    def retained(self):
+        """
+        Stacks of resources with DeletionPolicy Retain, which a teardown must leave alone
+        """
+        cfn = self.world.services['cloudformation']
+        parent = [s for s in cfn.stacks.values() if s['StackName'] == 'sim-parent'][0]
+        kept = set(r.get('PhysicalResourceId') for r in parent['Resources'].values()
+                   if r.get('DeletionPolicy') == 'Retain')
+        return [s for s in cfn.stacks.values() if s['StackId'] in kept or s['StackName'] in kept]
+
+    def leaks(self):
+        world = self.world
+        leaks = {}
+        retained = [s['StackId'] for s in self.retained()]
+        shared = self.module.SHARED_POLL_RULE
+        leaks['poll rules'] = len([r for r in world.services['events'].rules if r != shared])
+        leaks['invoke permissions'] = len([s for s in world.services['lambda'].statements if s != shared])
+        table = world.services['dynamodb'].tables.get(os.environ.get('POLL_STATE_TABLE'), {})
+        leaks['pending operations'] = len(table)
+        leaks['stacks'] = len([s for s in world.services['cloudformation'].stacks.values()
+                               if s['StackName'] != 'sim-parent' and s['StackStatus'] != 'DELETE_COMPLETE' and
+                               s['StackId'] not in retained])
+        return leaks
+
+
+class CodeBuildFunction(object):
+    name = 'CodeBuildContainer'
+    source = os.path.join(SAMPLES, 'cloudformation-codebuild-container')
+
+    def __init__(self, args, world):
+        self.args = args
+        self.world = world
+        os.environ.setdefault('BUILD_POLL_INTERVAL', '0.5')
+        sys.path.insert(0, self.source)
+        import lambda_codebuild
+        self.module = lambda_codebuild
+
+    def handler(self, event, context):
+        return self.module.lambda_handler(event, context)
+
+    def properties(self, index, version, parent_stack_id):
+        # one project and repository per resource, like the template in codebuild.yaml
+        self.world.services['codebuild'].add_project('sim-project-%s' % index, {
+            'AWS_ACCOUNT_ID': stubs.FUNCTION_ACCOUNT, 'IMAGE_REPO_NAME': 'sim-repo-%s' % index, 'IMAGE_TAG': 'latest'})
+        props = {
+            'ServiceToken': 'arn:aws:lambda:%s:%s:function:%s' % (stubs.FUNCTION_REGION, stubs.FUNCTION_ACCOUNT,
+                                                                  self.name),
+            'BuildProjectName': 'sim-project-%s' % index,
+            'ECRRepository': 'sim-repo-%s' % index,
+            'Version': str(version)
+        }
+        if self.args.cache_policy:
+            props['CachePolicy'] = self.args.cache_policy
+        if self.args.build_images:
+            props['Images'] = [{'Name': 'Image%s' % i, 'ECRRepository': 'sim-repo-%s-%s' % (index, i)}
+                               for i in range(self.args.build_images)]
+        return props
+
+    def check(self, phase, body):
+        problems = []
+        if body.get('Status') != 'SUCCESS' or phase == 'Delete':
+            return problems
+        names = ['Image%s.' % i for i in range(self.args.build_images)] or ['']
+        for name in names:
+            if not body.get('Data', {}).get(name + 'ImageDigest'):
+                problems.append('no %sImageDigest returned' % name)
+        return problems
+
+    def leaks(self):
+        ecr = self.world.services['ecr']
+        return {'images': sum(len(images) for images in ecr.repositories.values())}
+
+
+FUNCTIONS = {'cross-account': CrossAccountFunction, 'codebuild': CodeBuildFunction}
+
+
+class Simulator(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.world = stubs.World(stubs.Config(
+            latency=args.latency, throttle_rate=args.throttle_rate, rate_limit=args.rate_limit,
+            max_attempts=args.max_attempts, stack_seconds=args.stack_seconds, build_seconds=args.build_seconds,
+            images=args.images, failure_rate=args.failure_rate))
+        self.world.invoke_async = self.invoke
+        stubs.install(self.world)
+        self.function = FUNCTIONS[args.function](args, self.world)
+        self.parent_stack_id = [s for s in self.world.services['cloudformation'].stacks if '/sim-parent/' in s][0]
+        self.server = ResponseServer()
+        self.pool = ThreadPoolExecutor(max_workers=args.lambda_concurrency)
+        self.lock = threading.Lock()
+        self.invocations = []
+        self.latencies = {phase: [] for phase in PHASES}
+        self.results = {'lifecycles': 0, 'responses': 0, 'SUCCESS': 0, 'FAILED': 0, 'missing': 0, 'problems': []}
+        self.resources = {}
+        self.stopped = threading.Event()
+
+    def invoke(self, event):
+        """
+        Asynchronous invocation, like CloudFormation and EventBridge invoking the function
+        """
+        self.pool.submit(self._invoke, event)
+
+    def _invoke(self, event):
+        context = Context(self.function.name, self.args.timeout)
+        start = time.time()
+        error = None
+        try:
+            self.function.handler(json.loads(json.dumps(event)), context)
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        with self.lock:
+            self.invocations.append((time.time() - start, error))
+
+    def schedule(self):
+        """
+        Fire every enabled rule's targets once per tick
+        """
+        while not self.stopped.wait(self.args.tick):
+            for payload in self.world.services['events'].scheduled_inputs():
+                self.invoke(json.loads(payload))
+
+    def lifecycle(self, index, phases=PHASES):
+        # physical id and properties carried from one phase to the next, teardown runs the delete phase separately
+        resource = self.resources.setdefault(index, {'physical_id': None, 'old_props': None, 'stopped': False})
+        physical_id = resource['physical_id']
+        old_props = resource['old_props']
+        for version, phase in enumerate(PHASES):
+            if phase not in phases or resource['stopped']:
+                continue
+            if phase == 'Update' and old_props is None:
+                continue
+            path = '/%s/%s' % (index, phase)
+            # Delete carries the properties of the last update, an unchanged update those of the create
+            props = self.function.properties(index, 0 if self.args.unchanged_update else min(version, 1),
+                                             self.parent_stack_id)
+            event = self.event(index, phase, path, props, physical_id)
+            if phase == 'Delete':
+                self.set_resource(index, 'DELETE_IN_PROGRESS', physical_id)
+            if phase == 'Update':
+                event['OldResourceProperties'] = old_props
+            start = time.time()
+            self.invoke(event)
+            response = self.server.wait(path, self.args.phase_timeout)
+            with self.lock:
+                if response is None:
+                    self.results['missing'] += 1
+                    self.results['problems'].append('%s: no response within %ss' % (path, self.args.phase_timeout))
+                    resource['stopped'] = True
+                    return
+                received, body = response
+                self.latencies[phase].append(received - start)
+                self.record(path, phase, event, body)
+            if phase == 'Create':
+                # like CloudFormation, a failed create is still deleted using the physical id it returned
+                physical_id = body.get('PhysicalResourceId')
+                old_props = props if body.get('Status') == 'SUCCESS' else None
+            if phase == 'Update' and body.get('Status') == 'SUCCESS' and body.get('PhysicalResourceId') != physical_id:
+                if not self.replacing():
+                    with self.lock:
+                        self.results['problems'].append('%s: physical id changed' % path)
+                else:
+                    self.cleanup(index, physical_id, old_props)
+                    physical_id = body.get('PhysicalResourceId')
+                    old_props = props
+            if body.get('Status') == 'SUCCESS':
+                self.set_resource(index, PHASE_COMPLETE[phase], physical_id)
+        resource.update(physical_id=physical_id, old_props=old_props)
+        if 'Delete' in phases:
+            with self.lock:
+                self.results['lifecycles'] += 1
+
+    def event(self, index, phase, path, props, physical_id):
+        event = {
+            'RequestType': phase,
+            'ServiceToken': props['ServiceToken'],
+            'ResponseURL': self.server.url(path),
+            'StackId': self.parent_stack_id,
+            'RequestId': str(uuid.uuid4()),
+            'LogicalResourceId': 'Resource%s' % index,
+            'ResourceType': 'Custom::Simulated',
+            'ResourceProperties': props
+        }
+        if physical_id is not None:
+            event['PhysicalResourceId'] = physical_id
+        return event
+
+    def replacing(self):
+        # updates to a different number of fan-out targets, or between a single stack and fan-out, replace resources
+        return self.args.update_targets is not None and self.args.update_targets != self.args.targets
+
+    def cleanup(self, index, physical_id, props):
+        """
+        Delete the resource an update replaced, with its old properties, as CloudFormation does once the update of
+        the parent stack completes
+        """
+        path = '/%s/Cleanup' % index
+        event = self.event(index, 'Delete', path, props, physical_id)
+        self.invoke(event)
+        response = self.server.wait(path, self.args.phase_timeout)
+        with self.lock:
+            if response is None:
+                self.results['missing'] += 1
+                self.results['problems'].append('%s: no response within %ss' % (path, self.args.phase_timeout))
+                return
+            self.record(path, 'Delete', event, response[1])
+
+    def set_resource(self, index, status, physical_id=None):
+        # the resource as listed by the parent stack, the first --retain resources are kept by their DeletionPolicy
+        self.world.services['cloudformation'].set_resource(
+            self.parent_stack_id, 'Resource%s' % index, status, physical_id,
+            'Retain' if index < self.args.retain else None)
+
+    def record(self, path, phase, event, body):
+        self.results['responses'] += 1
+        status = body.get('Status')
+        if status in ['SUCCESS', 'FAILED']:
+            self.results[status] += 1
+        problems = [] if status in ['SUCCESS', 'FAILED'] else ['invalid status %s' % status]
+        for key in ['StackId', 'RequestId', 'LogicalResourceId']:
+            if body.get(key) != event[key]:
+                problems.append('%s does not match the request' % key)
+        if not body.get('PhysicalResourceId'):
+            problems.append('no physical id')
+        if status == 'FAILED' and not self.args.failure_rate:
+            problems.append('failed: %s' % body.get('Reason'))
+        problems += self.function.check(phase, body)
+        self.results['problems'] += ['%s: %s' % (path, p) for p in problems]
+
+    def run(self):
+        scheduler = threading.Thread(target=self.schedule, daemon=True)
+        scheduler.start()
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as drivers:
+            if self.args.teardown:
+                # every resource is created and updated, then the parent stack is deleted and, as if each resource
+                # depended on the previous one, CloudFormation deletes them one at a time in reverse order
+                list(drivers.map(lambda index: self.lifecycle(index, PHASES[:-1]), range(self.args.resources)))
+                self.world.services['cloudformation'].stacks[self.parent_stack_id].update(
+                    StackStatus='DELETE_IN_PROGRESS', Operation='Delete', ReadyAt=float('inf'))
+                for index in reversed(range(self.args.resources)):
+                    if index < self.args.retain:
+                        # kept by its DeletionPolicy, CloudFormation doesn't call the function
+                        self.set_resource(index, 'DELETE_SKIPPED')
+                        continue
+                    self.lifecycle(index, PHASES[-1:])
+            else:
+                list(drivers.map(self.lifecycle, range(self.args.resources)))
+        self.elapsed = time.time() - start
+        # let stray invocations finish, then check nothing is left behind
+        time.sleep(self.args.tick * 2)
+        self.stopped.set()
+        self.pool.shutdown(wait=True)
+        self.server.shutdown()
+        duplicates = [p for p, r in self.server.responses.items() if len(r) > 1]
+        self.results['problems'] += ['%s: %s responses' % (p, len(self.server.responses[p])) for p in duplicates]
+        if self.args.retain:
+            self.results['problems'] += ['retained stack %s was deleted' % s['StackName']
+                                         for s in self.function.retained() if s['StackStatus'].startswith('DELETE')]
+        return self.report()
+
+    def report(self):
+        return {
+            'function': self.args.function,
+            'resources': self.args.resources,
+            'elapsed': round(self.elapsed, 2),
+            'phases': {phase: percentiles(values) for phase, values in self.latencies.items() if values},
+            'invocations': {
+                'count': len(self.invocations),
+                'errors': len([i for i in self.invocations if i[1]]),
+                'duration': percentiles([i[0] for i in self.invocations])
+            },
+            'api_calls': dict(sorted(self.world.calls.items(), key=lambda c: -c[1])),
+            'throttled_attempts': self.world.throttles,
+            'responses': {k: v for k, v in self.results.items() if k != 'problems'},
+            'leaks': self.function.leaks(),
+            'problems': self.results['problems']
+        }
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))], 3)
+
+    return {'count': len(values), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(values[-1], 3)}
+
+
+def print_report(report):
+    print("%s: %s resources in %ss" % (report['function'], report['resources'], report['elapsed']))
+    print("\n%-12s %7s %9s %9s %9s %9s" % ('phase', 'count', 'p50', 'p90', 'p99', 'max'))
+    rows = list(report['phases'].items()) + [('invocation', report['invocations']['duration'])]
+    for name, p in rows:
+        if p:
+            print("%-12s %7s %8.3fs %8.3fs %8.3fs %8.3fs" % (name, p['count'], p['p50'], p['p90'], p['p99'],
+                                                              p['max']))
+    print("\nAPI calls (%s attempts throttled)" % report['throttled_attempts'])
+    for name, count in report['api_calls'].items():
+        print("  %-40s %7s" % (name, count))
+    print("\nResponses: " + ", ".join("%s %s" % (k, v) for k, v in report['responses'].items()))
+    print("Invocation errors: %s" % report['invocations']['errors'])
+    print("Left behind: " + ", ".join("%s %s" % (k, v) for k, v in report['leaks'].items()))
+    if report['problems']:
+        print("\n%s problem(s):" % len(report['problems']))
+        for problem in report['problems'][:20]:
+            print("  " + problem)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--function", choices=sorted(FUNCTIONS), default='cross-account')
+    parser.add_argument("--resources", type=int, default=10, help="Number of resource lifecycles")
+    parser.add_argument("--concurrency", type=int, default=10, help="Lifecycles running at the same time")
+    parser.add_argument("--lambda-concurrency", type=int, default=100, help="Concurrent Lambda invocations")
+    parser.add_argument("--poll-mode", choices=['rule', 'shared', 'inline'], default='rule',
+                        help="How the cross-account function waits for stacks")
+    parser.add_argument("--targets", type=int, default=0, help="Fan-out targets per cross-account resource")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mean API call latency in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability an API call is throttled")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="Requests per second per service, account and region before throttling, 0 for none")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Attempts per API call, as botocore retries")
+    parser.add_argument("--teardown", action="store_true",
+                        help="Delete the resources one at a time once the parent stack is DELETE_IN_PROGRESS, with "
+                             "the cross-account function's teardown mode on unless TEARDOWN=false is set")
+    parser.add_argument("--retain", type=int, default=0,
+                        help="With --teardown, resources with DeletionPolicy Retain, which are not deleted")
+    parser.add_argument("--update-targets", type=int,
+                        help="Fan-out targets after the update, 0 for a single stack. Differing from --targets "
+                             "replaces the resources and deletes the old ones")
+    parser.add_argument("--unchanged-update", action="store_true",
+                        help="Update with the properties of the create, like an update of unrelated stack resources")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability a stack operation fails")
+    parser.add_argument("--stack-seconds", type=float, default=2.0, help="Mean stack operation duration")
+    parser.add_argument("--build-seconds", type=float, default=2.0, help="Mean CodeBuild build duration")
+    parser.add_argument("--build-images", type=int, default=0,
+                        help="Images built by each codebuild resource in batch mode, 0 for a single build")
+    parser.add_argument("--cache-policy", choices=['NONE', 'LOCAL', 'S3', 'REGISTRY'],
+                        help="CachePolicy of the codebuild resources")
+    parser.add_argument("--images", type=int, default=0, help="Images in each ECR repository before delete")
+    parser.add_argument("--tick", type=float, default=1.0, help="Seconds between scheduled rule invocations")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Lambda timeout in seconds")
+    parser.add_argument("--phase-timeout", type=float, default=120.0, help="Seconds to wait for each response")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    parser.add_argument("--json", help="Also write the report as json to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the handlers' logs and output")
+    args = parser.parse_args()
+    if args.retain and (not args.teardown or args.function != 'cross-account'):
+        parser.error("--retain needs --teardown and the cross-account function")
+    if args.update_targets is not None and (args.function != 'cross-account' or args.unchanged_update):
+        parser.error("--update-targets needs the cross-account function and an update that changes properties")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    stdout = sys.stdout
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        report = Simulator(args).run()
+    finally:
+        sys.stdout = stdout
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if report['problems'] or any(report['leaks'].values()) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,786 @@
+"""
+In-process stand-ins for the AWS services used by the custom resource Lambdas, and for the boto3/botocore entry
+points the handlers import. Every stub call goes through StubClient, which adds the configured latency, simulates
+throttling with botocore style retries and runs the before-call/after-call hooks registered on the client.
+"""
+import hashlib
+import io
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import types
+import urllib.request
+import uuid
+import zipfile
+
+FUNCTION_ACCOUNT = '111111111111'
+FUNCTION_REGION = 'us-east-1'
+
+
+class ClientError(Exception):
+    """
+    Same constructor and attributes as botocore.exceptions.ClientError
+    """
+
+    def __init__(self, error_response, operation_name):
+        self.response = error_response
+        self.operation_name = operation_name
+        error = error_response.get('Error', {})
+        super(ClientError, self).__init__("An error occurred (%s) when calling the %s operation: %s" % (
+            error.get('Code', 'Unknown'), operation_name, error.get('Message', 'Unknown')))
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def operation_name(method):
+    return ''.join(part.capitalize() for part in method.split('_'))
+
+
+class Emitter(object):
+    """
+    Minimal hierarchical event emitter, a handler registered for "before-call" receives "before-call.<service>.<op>"
+    """
+
+    def __init__(self, handlers=None):
+        self.handlers = list(handlers or [])
+
+    def register(self, event_name, handler, **kwargs):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in list(self.handlers):
+            if event_name == name or event_name.startswith(name + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class Config(object):
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, rate_limit=0, max_attempts=3, stack_seconds=2.0,
+                 build_seconds=2.0, images=0, failure_rate=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.max_attempts = max_attempts
+        self.stack_seconds = stack_seconds
+        self.build_seconds = build_seconds
+        self.images = images
+        self.failure_rate = failure_rate
+
+
+class World(object):
+    """
+    Shared state of all stub services plus call accounting
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.RLock()
+        self.calls = {}
+        self.throttles = 0
+        self.invoke_async = None
+        self._windows = {}
+        self.services = {
+            'cloudformation': CloudFormation(self),
+            'events': Events(self),
+            'lambda': Lambda(self),
+            'sts': Sts(self),
+            'ecr': Ecr(self),
+            'codebuild': CodeBuild(self),
+            's3': S3(self),
+            'dynamodb': DynamoDB(self),
+        }
+
+    def count(self, service, operation):
+        with self.lock:
+            key = "%s.%s" % (service, operation)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def over_rate_limit(self, service, account, region):
+        """
+        Per service/account/region request rate limit over one second windows
+        """
+        if not self.config.rate_limit:
+            return False
+        with self.lock:
+            window = int(time.time())
+            key = (service, account, region, window)
+            self._windows[key] = self._windows.get(key, 0) + 1
+            return self._windows[key] > self.config.rate_limit
+
+
+class StubClient(object):
+
+    def __init__(self, world, service, account, region, emitter=None):
+        if service not in world.services:
+            raise Exception("No stub for service %s" % service)
+        self._world = world
+        self._service = service
+        self._impl = world.services[service]
+        self._account = account
+        self._region = region or FUNCTION_REGION
+        self.meta = types.SimpleNamespace(events=emitter or Emitter(), region_name=self._region)
+
+    def __getattr__(self, method):
+        if method.startswith('_') or not hasattr(self._impl, method):
+            raise AttributeError(method)
+        return lambda **kwargs: self._call(method, kwargs)
+
+    def get_paginator(self, method):
+        return Paginator(self, method)
+
+    def _call(self, method, kwargs):
+        world = self._world
+        operation = operation_name(method)
+        model = types.SimpleNamespace(name=operation, service_model=types.SimpleNamespace(
+            service_name=self._service))
+        context = {}
+        self.meta.events.emit('before-call.%s.%s' % (self._service, operation), model=model, params=kwargs,
+                              context=context)
+        retries = 0
+        try:
+            while True:
+                world.count(self._service, operation)
+                self.meta.events.emit('before-send.%s.%s' % (self._service, operation), request=None)
+                if world.config.latency:
+                    time.sleep(world.config.latency * random.uniform(0.5, 1.5))
+                throttled = random.random() < world.config.throttle_rate or \
+                    world.over_rate_limit(self._service, self._account, self._region)
+                if not throttled:
+                    break
+                with world.lock:
+                    world.throttles += 1
+                error = {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                         'ResponseMetadata': {'HTTPStatusCode': 400, 'RetryAttempts': retries}}
+                self.meta.events.emit('needs-retry.%s.%s' % (self._service, operation),
+                                      response=(None, error), attempts=retries + 1, operation=model)
+                if retries + 1 >= world.config.max_attempts:
+                    self.meta.events.emit('after-call.%s.%s' % (self._service, operation), http_response=None,
+                                          parsed=error, model=model, context=context)
+                    raise ClientError(error, operation)
+                retries += 1
+                time.sleep(random.uniform(0, 0.05 * 2 ** retries))
+            response = getattr(self._impl, method)(self, **kwargs) or {}
+        except ClientError as e:
+            if 'api_metrics' in context or 'ResponseMetadata' not in e.response:
+                e.response.setdefault('ResponseMetadata', {'HTTPStatusCode': 400, 'RetryAttempts': retries})
+                self.meta.events.emit('after-call.%s.%s' % (self._service, operation), http_response=None,
+                                      parsed=e.response, model=model, context=context)
+            raise
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': retries}
+        self.meta.events.emit('after-call.%s.%s' % (self._service, operation), http_response=None,
+                              parsed=response, model=model, context=context)
+        return response
+
+
+class Paginator(object):
+    TOKENS = ['NextToken', 'nextToken']
+
+    def __init__(self, client, method):
+        self.client = client
+        self.method = method
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        if PaginationConfig and 'PageSize' in PaginationConfig:
+            # only the ECR stubs take a page size
+            kwargs['maxResults'] = PaginationConfig['PageSize']
+        while True:
+            page = getattr(self.client, self.method)(**kwargs)
+            yield page
+            token = [t for t in self.TOKENS if page.get(t)]
+            if not token:
+                return
+            kwargs[token[0]] = page[token[0]]
+
+
+def page(items, token, size):
+    start = int(token or 0)
+    end = start + size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class CloudFormation(object):
+    IN_PROGRESS = {'Create': 'CREATE_IN_PROGRESS', 'Update': 'UPDATE_IN_PROGRESS', 'Delete': 'DELETE_IN_PROGRESS'}
+    COMPLETE = {'Create': 'CREATE_COMPLETE', 'Update': 'UPDATE_COMPLETE', 'Delete': 'DELETE_COMPLETE'}
+
+    def __init__(self, world):
+        self.world = world
+        self.stacks = {}
+        self.add_parent('sim-parent')
+
+    def add_parent(self, name, account=FUNCTION_ACCOUNT, region=FUNCTION_REGION):
+        stack_id = 'arn:aws:cloudformation:%s:%s:stack/%s/%s' % (region, account, name, uuid.uuid4())
+        self.stacks[stack_id] = {
+            'StackId': stack_id, 'StackName': name, 'StackStatus': 'CREATE_COMPLETE', 'Account': account,
+            'Region': region, 'Capabilities': [], 'DisableRollback': False, 'NotificationARNs': [],
+            'RollbackConfiguration': {}, 'Tags': [], 'Outputs': [], 'Events': [], 'ReadyAt': 0, 'Resources': {}
+        }
+        return stack_id
+
+    def set_resource(self, stack_id, logical_id, status, physical_id=None, deletion_policy=None):
+        """
+        Record a resource of a parent stack, its template lists it with its DeletionPolicy
+        """
+        with self.world.lock:
+            resource = self.stacks[stack_id]['Resources'].setdefault(logical_id, {})
+            resource['ResourceStatus'] = status
+            if physical_id is not None:
+                resource['PhysicalResourceId'] = physical_id
+            if deletion_policy is not None:
+                resource['DeletionPolicy'] = deletion_policy
+
+    def _event(self, stack, status, logical_id=None, reason=None):
+        stack['Events'].insert(0, {
+            'EventId': str(uuid.uuid4()), 'StackId': stack['StackId'], 'StackName': stack['StackName'],
+            'LogicalResourceId': logical_id or stack['StackName'],
+            'PhysicalResourceId': stack['StackId'] if logical_id is None else logical_id + '-physical',
+            'ResourceType': 'AWS::CloudFormation::Stack' if logical_id is None else 'AWS::S3::Bucket',
+            'ResourceStatus': status, 'ResourceStatusReason': reason or '',
+            'Timestamp': _now()
+        })
+
+    def _advance(self, stack):
+        if not stack['StackStatus'].endswith('_IN_PROGRESS') or time.time() < stack['ReadyAt']:
+            return
+        operation = stack['Operation']
+        if stack.get('Fail'):
+            self._event(stack, operation.upper() + '_FAILED', 'Bucket', 'Simulated resource failure')
+            stack['StackStatus'] = 'ROLLBACK_COMPLETE' if operation == 'Create' else 'UPDATE_ROLLBACK_COMPLETE'
+        else:
+            stack['StackStatus'] = self.COMPLETE[operation]
+            if operation != 'Delete':
+                stack['Outputs'] = [{'OutputKey': 'BucketName', 'OutputValue': stack['StackName'].lower()}]
+        self._event(stack, stack['StackStatus'])
+
+    def _find(self, client, name, operation, include_deleted=False):
+        with self.world.lock:
+            for stack in self.stacks.values():
+                if stack['Account'] != client._account or stack['Region'] != client._region:
+                    continue
+                if stack['StackId'] == name or (stack['StackName'] == name and (
+                        include_deleted or stack['StackStatus'] != 'DELETE_COMPLETE')):
+                    self._advance(stack)
+                    return stack
+        raise client_error('ValidationError', 'Stack with id %s does not exist' % name, operation)
+
+    def _start(self, stack, operation):
+        stack['Operation'] = operation
+        stack['StackStatus'] = self.IN_PROGRESS[operation]
+        stack['ReadyAt'] = time.time() + self.world.config.stack_seconds * random.uniform(0.5, 1.5)
+        stack['Fail'] = operation != 'Delete' and random.random() < self.world.config.failure_rate
+        self._event(stack, stack['StackStatus'])
+
+    def create_stack(self, client, StackName, TemplateURL, Parameters=None, Capabilities=None, Tags=None,
+                     **kwargs):
+        with self.world.lock:
+            stack_id = 'arn:aws:cloudformation:%s:%s:stack/%s/%s' % (client._region, client._account, StackName,
+                                                                     uuid.uuid4())
+            stack = {
+                'StackId': stack_id, 'StackName': StackName, 'Account': client._account, 'Region': client._region,
+                'TemplateURL': TemplateURL, 'Parameters': Parameters or [], 'Capabilities': Capabilities or [],
+                'Tags': Tags or [], 'Outputs': [], 'Events': []
+            }
+            self.stacks[stack_id] = stack
+            self._start(stack, 'Create')
+        return {'StackId': stack_id}
+
+    def update_stack(self, client, StackName, TemplateURL, Parameters=None, Capabilities=None, Tags=None,
+                     **kwargs):
+        stack = self._find(client, StackName, 'UpdateStack')
+        with self.world.lock:
+            if stack['StackStatus'].endswith('_IN_PROGRESS'):
+                raise client_error('ValidationError', 'Stack is in %s state and can not be updated' %
+                                   stack['StackStatus'], 'UpdateStack')
+            unchanged = (stack['TemplateURL'], stack['Parameters'], stack['Tags']) == \
+                (TemplateURL, Parameters or [], Tags or [])
+            if unchanged:
+                raise client_error('ValidationError', 'No updates are to be performed.', 'UpdateStack')
+            stack.update(TemplateURL=TemplateURL, Parameters=Parameters or [], Tags=Tags or [])
+            self._start(stack, 'Update')
+        return {'StackId': stack['StackId']}
+
+    def delete_stack(self, client, StackName, **kwargs):
+        try:
+            stack = self._find(client, StackName, 'DeleteStack')
+        except ClientError:
+            return {}
+        with self.world.lock:
+            if stack['StackStatus'] != 'DELETE_COMPLETE':
+                self._start(stack, 'Delete')
+        return {}
+
+    def describe_stacks(self, client, StackName=None, NextToken=None):
+        if StackName:
+            return {'Stacks': [self._public(self._find(client, StackName, 'DescribeStacks'))]}
+        with self.world.lock:
+            stacks = [s for s in self.stacks.values() if s['Account'] == client._account and
+                      s['Region'] == client._region]
+            for stack in stacks:
+                self._advance(stack)
+            stacks = [s for s in stacks if s['StackStatus'] != 'DELETE_COMPLETE']
+            items, token = page([self._public(s) for s in stacks], NextToken, 100)
+        response = {'Stacks': items}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def describe_stack_events(self, client, StackName, NextToken=None):
+        stack = self._find(client, StackName, 'DescribeStackEvents', include_deleted=True)
+        with self.world.lock:
+            items, token = page(list(stack['Events']), NextToken, 100)
+        response = {'StackEvents': items}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def get_template_summary(self, client, TemplateURL=None, **kwargs):
+        # the parameters the simulator passes in CfnParameters
+        return {'Parameters': [{'ParameterKey': 'Index', 'ParameterType': 'String'},
+                               {'ParameterKey': 'Version', 'ParameterType': 'String'}],
+                'Capabilities': [], 'Version': '2010-09-09'}
+
+    def get_template(self, client, StackName, TemplateStage='Original'):
+        # a YAML template, as most parents have, listing the resources recorded with set_resource
+        stack = self._find(client, StackName, 'GetTemplate')
+        lines = ['AWSTemplateFormatVersion: "2010-09-09"', 'Resources:']
+        with self.world.lock:
+            for logical_id, resource in sorted(stack.get('Resources', {}).items()):
+                lines += ['  %s:' % logical_id, '    Type: Custom::Simulated']
+                if 'DeletionPolicy' in resource:
+                    lines.append('    DeletionPolicy: %s' % resource['DeletionPolicy'])
+        return {'TemplateBody': '\n'.join(lines) + '\n', 'StagesAvailable': ['Original', 'Processed']}
+
+    def list_stack_resources(self, client, StackName, NextToken=None):
+        stack = self._find(client, StackName, 'ListStackResources')
+        with self.world.lock:
+            summaries = [dict({k: v for k, v in resource.items() if k != 'DeletionPolicy'},
+                              LogicalResourceId=logical_id, ResourceType='Custom::Simulated')
+                         for logical_id, resource in sorted(stack.get('Resources', {}).items())]
+        items, token = page(summaries, NextToken, 100)
+        response = {'StackResourceSummaries': items}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def _public(self, stack):
+        return {k: v for k, v in stack.items() if k not in ['Account', 'Region', 'Events', 'ReadyAt', 'Operation',
+                                                            'Fail', 'TemplateURL', 'Resources']}
+
+
+class Events(object):
+
+    def __init__(self, world):
+        self.world = world
+        self.rules = {}
+
+    def put_rule(self, client, Name, ScheduleExpression=None, State='ENABLED', **kwargs):
+        arn = 'arn:aws:events:%s:%s:rule/%s' % (client._region, client._account, Name)
+        with self.world.lock:
+            rule = self.rules.setdefault(Name, {'Arn': arn, 'Targets': {}})
+            rule['ScheduleExpression'] = ScheduleExpression
+            rule['State'] = State
+        return {'RuleArn': arn}
+
+    def put_targets(self, client, Rule, Targets):
+        with self.world.lock:
+            if Rule not in self.rules:
+                raise client_error('ResourceNotFoundException', 'Rule %s does not exist' % Rule, 'PutTargets')
+            for target in Targets:
+                if len(target.get('Input', '')) > 8192:
+                    raise client_error('ValidationException', 'Input exceeds 8192 characters', 'PutTargets')
+                self.rules[Rule]['Targets'][target['Id']] = target
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    def remove_targets(self, client, Rule, Ids):
+        with self.world.lock:
+            if Rule not in self.rules:
+                raise client_error('ResourceNotFoundException', 'Rule %s does not exist' % Rule, 'RemoveTargets')
+            for target_id in Ids:
+                self.rules[Rule]['Targets'].pop(target_id, None)
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    def delete_rule(self, client, Name):
+        with self.world.lock:
+            if Name not in self.rules:
+                raise client_error('ResourceNotFoundException', 'Rule %s does not exist' % Name, 'DeleteRule')
+            if self.rules[Name]['Targets']:
+                raise client_error('ValidationException', 'Rule can\'t be deleted since it has targets.',
+                                   'DeleteRule')
+            del self.rules[Name]
+        return {}
+
+    def scheduled_inputs(self):
+        with self.world.lock:
+            return [t.get('Input', '{}') for r in self.rules.values() if r.get('State') == 'ENABLED'
+                    for t in r['Targets'].values()]
+
+
+class Lambda(object):
+
+    def __init__(self, world):
+        self.world = world
+        self.statements = {}
+
+    def add_permission(self, client, FunctionName, StatementId, **kwargs):
+        with self.world.lock:
+            if StatementId in self.statements:
+                raise client_error('ResourceConflictException', 'The statement id (%s) provided already exists'
+                                   % StatementId, 'AddPermission')
+            self.statements[StatementId] = kwargs
+        return {'Statement': json.dumps(kwargs)}
+
+    def remove_permission(self, client, FunctionName, StatementId, **kwargs):
+        with self.world.lock:
+            if self.statements.pop(StatementId, None) is None:
+                raise client_error('ResourceNotFoundException', 'Statement %s not found' % StatementId,
+                                   'RemovePermission')
+        return {}
+
+    def invoke(self, client, FunctionName, InvocationType='RequestResponse', Payload=b'{}', **kwargs):
+        if isinstance(Payload, bytes):
+            Payload = Payload.decode('utf-8')
+        self.world.invoke_async(json.loads(Payload))
+        return {'StatusCode': 202}
+
+
+class Sts(object):
+
+    def __init__(self, world):
+        self.world = world
+
+    def assume_role(self, client, RoleArn, RoleSessionName=None, DurationSeconds=3600, **kwargs):
+        return {'Credentials': {'AccessKeyId': 'ASIASIMULATED', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                                'Expiration': _now()},
+                'AssumedRoleUser': {'Arn': RoleArn}}
+
+
+class Ecr(object):
+
+    def __init__(self, world):
+        self.world = world
+        self.repositories = {}
+
+    def _images(self, repository):
+        with self.world.lock:
+            if repository not in self.repositories:
+                self.repositories[repository] = {
+                    'sha256:%064x' % random.getrandbits(256): {'imageTags': ['build-%s' % i],
+                                                               'imagePushedAt': _now()}
+                    for i in range(self.world.config.images)}
+            return self.repositories[repository]
+
+    def describe_images(self, client, repositoryName, registryId=None, nextToken=None, maxResults=100,
+                        imageIds=None, **kwargs):
+        images = self._images(repositoryName)
+        with self.world.lock:
+            details = [dict(detail, imageDigest=digest, repositoryName=repositoryName)
+                       for digest, detail in images.items()]
+        if imageIds:
+            wanted = [i.get('imageTag') for i in imageIds]
+            details = [d for d in details if set(d.get('imageTags', [])) & set(wanted)]
+            if not details:
+                raise client_error('ImageNotFoundException', 'Image not found', 'DescribeImages')
+        items, token = page(details, nextToken, min(maxResults, 1000))
+        response = {'imageDetails': items}
+        if token:
+            response['nextToken'] = token
+        return response
+
+    def list_images(self, client, repositoryName, registryId=None, nextToken=None, maxResults=100, **kwargs):
+        images = self._images(repositoryName)
+        with self.world.lock:
+            ids = [{'imageDigest': digest} for digest in images]
+        items, token = page(ids, nextToken, min(maxResults, 1000))
+        response = {'imageIds': items}
+        if token:
+            response['nextToken'] = token
+        return response
+
+    def batch_delete_image(self, client, repositoryName, imageIds, registryId=None):
+        if len(imageIds) > 100:
+            raise client_error('InvalidParameterException', 'imageIds must contain at most 100 items',
+                               'BatchDeleteImage')
+        images = self._images(repositoryName)
+        with self.world.lock:
+            for image_id in imageIds:
+                images.pop(image_id['imageDigest'], None)
+        return {'imageIds': imageIds, 'failures': []}
+
+    def batch_get_image(self, client, repositoryName, imageIds, registryId=None, **kwargs):
+        images = self._images(repositoryName)
+        with self.world.lock:
+            found = [i for i in imageIds if i.get('imageDigest') in images]
+        # the stub's manifest is just the digest
+        return {'images': [{'imageId': i, 'imageManifest': json.dumps({'digest': i['imageDigest']}),
+                            'imageManifestMediaType': 'application/vnd.docker.distribution.manifest.v2+json'}
+                           for i in found],
+                'failures': [{'imageId': i, 'failureCode': 'ImageNotFound'} for i in imageIds if i not in found]}
+
+    def put_image(self, client, repositoryName, imageManifest, imageTag=None, registryId=None, **kwargs):
+        digest = json.loads(imageManifest)['digest']
+        images = self._images(repositoryName)
+        with self.world.lock:
+            if digest not in images:
+                raise client_error('LayersNotFoundException', 'Image %s not found' % digest, 'PutImage')
+            if imageTag in images[digest].get('imageTags', []):
+                raise client_error('ImageAlreadyExistsException', 'Image with tag %s already exists' % imageTag,
+                                   'PutImage')
+            for detail in images.values():
+                detail['imageTags'] = [t for t in detail.get('imageTags', []) if t != imageTag]
+            images[digest]['imageTags'].append(imageTag)
+        return {'image': {'imageId': {'imageDigest': digest, 'imageTag': imageTag}, 'imageManifest': imageManifest}}
+
+    def push(self, repository, tags):
+        digest = 'sha256:%064x' % random.getrandbits(256)
+        images = self._images(repository)
+        with self.world.lock:
+            for detail in images.values():
+                detail['imageTags'] = [t for t in detail.get('imageTags', []) if t not in tags]
+            images[digest] = {'imageTags': list(tags), 'imagePushedAt': _now()}
+        return digest
+
+
+class CodeBuild(object):
+    """
+    Builds finish after build_seconds, then push an image to the stub ECR repository named by IMAGE_REPO_NAME and,
+    like the buildspec in codebuild.yaml, signal CloudFormation when cfn_signal_url is set. Projects are registered
+    with add_project, with the environment variables of the project definition. Builds that find a Docker layer
+    cache for their cfn_cache_policy take a third of the time
+    """
+    CACHED_FACTOR = 0.3
+
+    def __init__(self, world):
+        self.world = world
+        self.builds = {}
+        self.projects = {}
+        self.caches = set()
+        self.ids = itertools.count(1)
+
+    def add_project(self, name, environment):
+        self.projects[name] = dict(environment)
+
+    def start_build(self, client, projectName, environmentVariablesOverride=None, **kwargs):
+        if projectName not in self.projects:
+            raise client_error('ResourceNotFoundException', 'Project %s not found' % projectName, 'StartBuild')
+        env = dict(self.projects[projectName])
+        env.update({v['name']: v['value'] for v in environmentVariablesOverride or []})
+        build_id = '%s:%s' % (projectName, next(self.ids))
+        build = {'id': build_id, 'projectName': projectName, 'buildStatus': 'IN_PROGRESS', 'currentPhase': 'BUILD',
+                 'environment': {'environmentVariables': [{'name': k, 'value': v} for k, v in env.items()]},
+                 'overrides': kwargs, 'exportedEnvironmentVariables': []}
+        cache_key, cache_source = self._cache(projectName, env, kwargs)
+        duration = self.world.config.build_seconds * random.uniform(0.5, 1.5)
+        with self.world.lock:
+            self.builds[build_id] = build
+            hit = cache_key in self.caches
+        if hit:
+            duration *= self.CACHED_FACTOR
+        env.update(CACHE_SOURCE=cache_source if hit else 'none', CACHED_STEPS='5' if hit else '0')
+        timer = threading.Timer(duration, self._finish, args=[build, env, cache_key])
+        timer.daemon = True
+        timer.start()
+        return {'build': dict(build)}
+
+    def _cache(self, project_name, env, overrides):
+        policy = env.get('cfn_cache_policy', 'NONE')
+        if policy == 'LOCAL':
+            return ('LOCAL', project_name), 'local'
+        if policy == 'S3':
+            return ('S3', overrides['cacheOverride']['location']), 's3'
+        if policy == 'REGISTRY':
+            return ('REGISTRY', env['cfn_cache_from']), 'registry'
+        return None, 'none'
+
+    def _finish(self, build, env, cache_key=None):
+        repository = env['IMAGE_REPO_NAME']
+        tags = [env.get('IMAGE_TAG', 'latest')]
+        if env.get('cfn_build_fingerprint', 'placeholder') != 'placeholder':
+            tags.append(env['cfn_build_fingerprint'])
+        digest = self.world.services['ecr'].push(repository, tags)
+        with self.world.lock:
+            if cache_key:
+                self.caches.add(cache_key)
+            build['buildStatus'] = 'SUCCEEDED'
+            build['currentPhase'] = 'COMPLETED'
+            build['exportedEnvironmentVariables'] = [{'name': k, 'value': v} for k, v in [
+                ('IMAGE_DIGEST', digest), ('CACHE_SOURCE', env['CACHE_SOURCE']), ('CACHED_STEPS', env['CACHED_STEPS'])]]
+        if env.get('cfn_signal_url', 'placeholder') not in ['', 'placeholder']:
+            image_uri = '%s.dkr.ecr.%s.amazonaws.com/%s@%s' % (FUNCTION_ACCOUNT, FUNCTION_REGION, repository, digest)
+            body = json.dumps({'StackId': env['cfn_stack_id'], 'RequestId': env['cfn_request_id'],
+                               'LogicalResourceId': env['cfn_logical_resource_id'],
+                               'PhysicalResourceId': '1233244324', 'Status': 'SUCCESS',
+                               'Data': {'ImageUri': image_uri, 'ImageDigest': digest,
+                                        'Fingerprint': env.get('cfn_build_fingerprint', ''),
+                                        'CacheSource': env['CACHE_SOURCE'],
+                                        'CachedSteps': env['CACHED_STEPS']}}).encode('utf-8')
+            request = urllib.request.Request(env['cfn_signal_url'], data=body, method='PUT',
+                                             headers={'Content-Type': ''})
+            urllib.request.urlopen(request).read()
+
+    def batch_get_builds(self, client, ids):
+        with self.world.lock:
+            return {'builds': [dict(self.builds[i]) for i in ids if i in self.builds],
+                    'buildsNotFound': [i for i in ids if i not in self.builds]}
+
+    def list_builds_for_project(self, client, projectName, nextToken=None, **kwargs):
+        with self.world.lock:
+            ids = [b['id'] for b in self.builds.values() if b['projectName'] == projectName]
+        return {'ids': list(reversed(ids))}
+
+    def batch_get_projects(self, client, names):
+        return {'projects': [{
+            'name': n, 'source': {'type': 'S3', 'location': 'sim-bucket/%s/source.zip' % n},
+            'environment': {'image': 'aws/codebuild/standard:7.0', 'privilegedMode': True,
+                            'environmentVariables': [{'name': k, 'value': v} for k, v in self.projects[n].items()]},
+            'cache': {'type': 'NO_CACHE'}} for n in names if n in self.projects],
+            'projectsNotFound': [n for n in names if n not in self.projects]}
+
+
+class DynamoDB(object):
+    """
+    Tables exist on first use and are keyed by a string attribute named Key, as the poll state table. A scan returns
+    every item in one page. Conditions are limited to attribute_exists on the key
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.tables = {}
+
+    def put_item(self, client, TableName, Item, **kwargs):
+        with self.world.lock:
+            self.tables.setdefault(TableName, {})[Item['Key']['S']] = json.loads(json.dumps(Item))
+        return {}
+
+    def get_item(self, client, TableName, Key, **kwargs):
+        with self.world.lock:
+            item = self.tables.get(TableName, {}).get(Key['Key']['S'])
+        return {'Item': item} if item is not None else {}
+
+    def delete_item(self, client, TableName, Key, ConditionExpression=None, **kwargs):
+        with self.world.lock:
+            item = self.tables.get(TableName, {}).pop(Key['Key']['S'], None)
+        if item is None and ConditionExpression:
+            raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'DeleteItem')
+        return {}
+
+    def scan(self, client, TableName, **kwargs):
+        with self.world.lock:
+            items = list(self.tables.get(TableName, {}).values())
+        return {'Items': items, 'Count': len(items)}
+
+
+class S3(object):
+    """
+    Every object is a zipped build source bundle with a Dockerfile
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.bundles = {}
+
+    def _bundle(self, bucket, key):
+        with self.world.lock:
+            if (bucket, key) not in self.bundles:
+                data = io.BytesIO()
+                with zipfile.ZipFile(data, 'w') as z:
+                    z.writestr('Dockerfile', 'FROM public.ecr.aws/docker/library/alpine:3\nCOPY . /app\n')
+                    z.writestr('app.py', 'print("%s")\n' % key)
+                self.bundles[(bucket, key)] = data.getvalue()
+            return self.bundles[(bucket, key)]
+
+    def head_object(self, client, Bucket, Key, **kwargs):
+        bundle = self._bundle(Bucket, Key)
+        return {'ETag': '"%s"' % hashlib.md5(bundle).hexdigest(), 'ContentLength': len(bundle)}
+
+    def get_object(self, client, Bucket, Key, **kwargs):
+        bundle = self._bundle(Bucket, Key)
+        return {'ETag': '"%s"' % hashlib.md5(bundle).hexdigest(), 'ContentLength': len(bundle),
+                'Body': io.BytesIO(bundle)}
+
+
+def _now():
+    import datetime
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def install(world):
+    """
+    Register fake boto3 and botocore modules backed by world in sys.modules, must be called before the handlers
+    are imported. Clients created without a role belong to FUNCTION_ACCOUNT, clients of an assumed role session
+    to the account in the role arn
+    """
+    boto3 = types.ModuleType('boto3')
+    boto3.client = lambda service, region_name=None, **kwargs: StubClient(world, service, FUNCTION_ACCOUNT,
+                                                                           region_name)
+    botocore = types.ModuleType('botocore')
+    exceptions = types.ModuleType('botocore.exceptions')
+    exceptions.ClientError = ClientError
+    credentials = types.ModuleType('botocore.credentials')
+    session = types.ModuleType('botocore.session')
+
+    class AssumeRoleCredentialFetcher(object):
+        def __init__(self, client_creator, source_credentials, role_arn, extra_args=None, **kwargs):
+            self.client_creator = client_creator
+            self.role_arn = role_arn
+            self.extra_args = extra_args or {}
+            self._credentials = None
+
+        def fetch_credentials(self):
+            if self._credentials is None:
+                self._credentials = self.client_creator('sts').assume_role(RoleArn=self.role_arn,
+                                                                           **self.extra_args)['Credentials']
+            return self._credentials
+
+    class CredentialResolver(object):
+        def __init__(self, providers):
+            self.providers = providers
+
+    class DeferredRefreshableCredentials(object):
+        def __init__(self, refresh_using, method, time_fetcher=None):
+            self.refresh_using = refresh_using
+            self.method = method
+
+    class Session(object):
+        def __init__(self):
+            self._emitter = Emitter()
+            self._components = {}
+            self._credentials = None
+
+        def register(self, event_name, handler, **kwargs):
+            self._emitter.register(event_name, handler)
+
+        def register_component(self, name, component):
+            self._components[name] = component
+
+        def get_credentials(self):
+            return None
+
+        def create_client(self, service, region_name=None, **kwargs):
+            account = FUNCTION_ACCOUNT
+            resolver = self._components.get('credential_provider')
+            if resolver:
+                if self._credentials is None:
+                    self._credentials = resolver.providers[0].load()
+                fetcher = self._credentials.refresh_using.__self__
+                fetcher.fetch_credentials()
+                account = fetcher.role_arn.split(":")[4]
+            return StubClient(world, service, account, region_name, Emitter(self._emitter.handlers))
+
+    credentials.AssumeRoleCredentialFetcher = AssumeRoleCredentialFetcher
+    credentials.CredentialResolver = CredentialResolver
+    credentials.DeferredRefreshableCredentials = DeferredRefreshableCredentials
+    session.Session = Session
+    botocore.exceptions = exceptions
+    botocore.credentials = credentials
+    botocore.session = session
+    sys.modules.update({
+        'boto3': boto3,
+        'botocore': botocore,
+        'botocore.exceptions': exceptions,
+        'botocore.credentials': credentials,
+        'botocore.session': session
+    })
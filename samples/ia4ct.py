@@ -1,88 +1,875 @@
 #!/usr/bin/env python
-import sys
+"""
+Generate a Customizations for Control Tower (CfCT) manifest from the parameters of a CloudFormation template.
+
+Can be run as a script or imported, so many manifests can be generated in one process:
+
+    import ia4ct
+    template = ia4ct.parse_template('templates/linux-bastion.template')
+    print(ia4ct.render_manifest(template, verbose=True))
+
+With --batch, templates from directories and globs are processed on a process pool into one manifest each or into
+a single combined manifest:
+
+    python ia4ct.py --batch templates --batch 'submodules/*/templates' --combined temp/manifest.yaml
+
+--cache FILE skips manifests whose template content and options are unchanged since they were last written, and
+--watch keeps running and regenerates the manifests of templates as they change. --nested prints how parameters
+are passed to nested stacks instead.
+"""
 import argparse
-from typing import DefaultDict
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import yaml
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
 from yaml.error import YAMLError
+from yaml.events import MappingEndEvent, MappingStartEvent, SequenceEndEvent, SequenceStartEvent, StreamEndEvent
+from yaml.resolver import Resolver
 
-parser = argparse.ArgumentParser()
+MANIFEST_VERSION = '2021-03-15'
+REGION_PLACEHOLDER = '[The region where Customization for Control Tower is deployed]'
+NAME_PLACEHOLDER = '[The name for this deployment]'
+RESOURCE_FILE_PLACEHOLDER = '[The s3 path where the template is located.]'
+OU_PLACEHOLDER = '[Enter your Organizational Unit]'
+DEPLOY_REGION_PLACEHOLDER = '[The region where you wish to deploy this workload]'
+# Parameter properties written as help comments in a verbose manifest, in this order
+HELP_PROPERTIES = ['Description', 'AllowedPattern', 'AllowedValues', 'ConstraintDescription', 'MaxLength',
+                   'MaxValue', 'MinLength', 'MinValue', 'NoEcho', 'Type']
+FORMATS = ['yaml', 'json']
+# Bump when a change to this script changes the manifests it writes, so cached manifests are regenerated
+CACHE_VERSION = 1
+# Top level template sections a manifest is generated from, the rest of the template isn't loaded
+MANIFEST_SECTIONS = ['Description', 'Metadata', 'Parameters']
+# File name endings picked up when a batch input is a directory, longest first so the stem is found correctly
+TEMPLATE_SUFFIXES = ['.template.yaml', '.template.yml', '.template.json', '.template', '.yaml', '.yml', '.json']
 
-parser.add_argument("path", nargs='?', default="templates/linux-bastion.template", help="Provide a path to the template file", type=str)
-parser.add_argument("outPath", nargs='?', default="temp/py_manifest.yaml", help="Provide a destination path for the output file", type=str)
-parser.add_argument("-v", "--verboseManifest", help="Include help comments in the manifest", action="store_true")
-args = parser.parse_args()
-# print(args.path)
-# print(args.verboseManifest)
 
 class CtParameter(yaml.YAMLObject):
     yaml_tag = u'!Parameters'
-    def __init__(self, name):
+
+    def __init__(self, name, properties=None):
         self.name = name
-        pass
+        for key, value in (properties or {}).items():
+            setattr(self, key, value)
+
     def method(self, arg):
         return True
 
-try:
-    yaml.add_multi_constructor('!', lambda loader, suffix, node: None)
-    # Read Yaml file
-    cfn = yaml.full_load(open(args.path, 'r'))
-    # Container for each parameter object
-    parameters = []
-    # Get data for each parameter
-    for n in cfn['Parameters']:
-        ctParm = CtParameter(n)
-        #ctParm.name = n
-        for i in cfn['Parameters'][n]:
-            setattr(ctParm, i, cfn['Parameters'][n][i])
-        # Append the parameter data to the list
-        parameters.append(ctParm)
-
-    # Create the manifest file and write the document
-    m = open(args.outPath, "w+")
-    m.write("---\n")
-    m.write("region: [The region where Customization for Control Tower is deployed]\n")
-    m.write("version: 2021-03-15\n")
-    m.write("resources:\n")
-    m.write("  - name: [The name for this deployment]\n")
-    m.write("    description: " + cfn['Description'] + "\n")
-    m.write("    resource_file: [The s3 path where the template is located.]\n")
-    m.write("    parameters:\n")
+    def help(self):
+        """
+        Return (property, text) pairs for the help comments of a verbose manifest
+        """
+        comments = []
+        for key in HELP_PROPERTIES:
+            if not hasattr(self, key):
+                continue
+            value = getattr(self, key)
+            if key == 'AllowedValues':
+                value = ' '.join(str(v) for v in value)
+            comments.append((key, str(value)))
+        return comments
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+if getattr(yaml, '__with_libyaml__', False):
+    from yaml.cyaml import CParser
+
+    class _BaseLoader(CParser, Composer, SafeConstructor, Resolver):
+        """
+        The libyaml parser with the python composer on top, so that a loader can compose single nodes as well as
+        load whole documents with libyaml's own composer
+        """
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+else:
+    _BaseLoader = yaml.SafeLoader
+
+
+class TemplateLoader(_BaseLoader):
+    """
+    Safe loader for CloudFormation templates, using libyaml when PyYAML was built with it. Short form intrinsic
+    functions are loaded as their long form, !Ref Name is {'Ref': 'Name'} and !GetAtt Res.Attr is
+    {'Fn::GetAtt': ['Res', 'Attr']}
+    """
+
+
+def construct_intrinsic(loader, suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.', 1)
+    if suffix in ['Ref', 'Condition']:
+        return {suffix: value}
+    return {'Fn::' + suffix: value}
+
+
+TemplateLoader.add_multi_constructor('!', construct_intrinsic)
+
+
+def _skip_node(loader):
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (MappingEndEvent, SequenceEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def _load_sections(loader, sections):
+    """
+    Load only the given top level sections of a template, the others are skipped at the parser event level without
+    building nodes or objects for them and are kept as keys with a None value. An alias in a loaded section can't
+    refer to an anchor in a skipped one
+    """
+    loader.get_event()
+    if loader.check_event(StreamEndEvent):
+        return None
+    loader.get_event()
+    if not loader.check_event(MappingStartEvent):
+        return loader.construct_document(loader.compose_node(None, None))
+    loader.get_event()
+    cfn = {}
+    while not loader.check_event(MappingEndEvent):
+        key = loader.construct_object(loader.compose_node(None, None), deep=True)
+        if key in sections:
+            cfn[key] = loader.construct_object(loader.compose_node(None, None), deep=True)
+        else:
+            _skip_node(loader)
+            cfn[key] = None
+    return cfn
+
+
+def _load(stream, sections):
+    loader = TemplateLoader(stream)
+    try:
+        if sections is None:
+            return loader.get_single_data()
+        return _load_sections(loader, sections)
+    finally:
+        loader.dispose()
 
+
+def load_template(source, sections=None):
+    """
+    Read a template from a path, an open file or a string of yaml or json. With sections, only those top level
+    sections are loaded (see _load_sections). Raises YAMLError when it can't be parsed
+    """
+    if hasattr(source, 'read'):
+        return _load(source, sections)
+    if '\n' not in source and os.path.exists(source):
+        with open(source, 'rb') as f:
+            return _load(f, sections)
+    return _load(source, sections)
+
+
+def parse_template(source):
+    """
+    Return the parts of a template that go into a manifest: {'Description': str, 'Parameters': [CtParameter]},
+    with the parameters sorted by name. source is anything load_template() accepts, or an already loaded template
+    """
+    cfn = source if isinstance(source, dict) else load_template(source, MANIFEST_SECTIONS)
+    if not isinstance(cfn, dict) or not ('Resources' in cfn or 'Parameters' in cfn):
+        name = source if isinstance(source, str) and '\n' not in source else getattr(source, 'name', 'source')
+        raise YAMLError("%s is not a CloudFormation template" % name)
+    parameters = [CtParameter(n, cfn['Parameters'][n] or {}) for n in (cfn.get('Parameters') or {})]
     parameters.sort(key=lambda x: x.name)
-    for p in parameters:
-        if args.verboseManifest:
-            if hasattr(p,"Description"):
-                m.write("      # Description: " + p.Description + "\n")
-            if hasattr(p,"AllowedPattern"):
-                m.write("      # AllowedPattern: " + p.AllowedPattern + "\n")
-            if hasattr(p,"AllowedValues"):
-                m.write("      # AllowedValues: " + ' '.join(str(v) for v in p.AllowedValues) + "\n")
-            if hasattr(p,"ConstraintDescription"):
-                m.write("      # ConstraintDescription: " + p.ConstraintDescription + "\n")
-            if hasattr(p,"MaxLength"):
-                m.write("      # MaxLength: " + p.MaxLength + "\n")
-            if hasattr(p,"MaxValue"):
-                m.write("      # MaxValue: " + p.MaxValue + "\n")
-            if hasattr(p,"MinLength"):
-                m.write("      # MinLength: " + p.MinLength + "\n")
-            if hasattr(p,"MinValue"):
-                m.write("      # MinValue: " + p.MinValue + "\n")
-            if hasattr(p,"NoEcho"):
-                m.write("      # NoEcho: " + p.NoEcho + "\n")
-            if hasattr(p,"Type"):
-                m.write("      # Type: " + p.Type + "\n")
-        m.write("      - parameter_key: " + p.name + "\n")
-        if hasattr(p,"Default"):
-                m.write("        parameter_value: " + str(p.Default) + "\n")
+    return {'Description': cfn.get('Description') or '', 'Parameters': parameters}
+
+
+def manifest_resource(template, name=NAME_PLACEHOLDER, resource_file=RESOURCE_FILE_PLACEHOLDER):
+    """
+    Return the manifest resource entry for a parsed template as a dict
+    """
+    return {
+        'name': name,
+        'description': template['Description'],
+        'resource_file': resource_file,
+        'parameters': [
+            {'parameter_key': p.name, 'parameter_value': getattr(p, 'Default', None)}
+            for p in template['Parameters']
+        ],
+        'deploy_method': 'stack_set',
+        'deployment_targets': {'organizational_units': [OU_PLACEHOLDER]},
+        'regions': [DEPLOY_REGION_PLACEHOLDER]
+    }
+
+
+def manifest_document(template, **kwargs):
+    """
+    Return the whole manifest for a parsed template as a dict. kwargs are passed to manifest_resource()
+    """
+    return {
+        'region': REGION_PLACEHOLDER,
+        'version': MANIFEST_VERSION,
+        'resources': [manifest_resource(template, **kwargs)]
+    }
+
+
+def _yaml_value(value):
+    if value is None:
+        return ''
+    return str(value)
+
+
+def render_document_yaml(document, help_comments=None):
+    """
+    Render a manifest document as yaml in a single string. The layout is written by hand rather than with yaml.dump
+    so the placeholders stay as they are and help comments can sit next to each parameter. help_comments has one
+    {parameter name: [(property, text)]} dict per resource
+    """
+    lines = [
+        "---",
+        "region: " + document['region'],
+        "version: " + document['version'],
+        "resources:"
+    ]
+    for index, resource in enumerate(document['resources']):
+        comments = help_comments[index] if help_comments else {}
+        lines.append("  - name: " + resource['name'])
+        lines.append("    description: " + _yaml_value(resource['description']))
+        lines.append("    resource_file: " + resource['resource_file'])
+        lines.append("    parameters:")
+        for parameter in resource['parameters']:
+            for key, text in comments.get(parameter['parameter_key'], []):
+                lines.append("      # %s: %s" % (key, text))
+            lines.append("      - parameter_key: " + parameter['parameter_key'])
+            lines.append("        parameter_value: " + _yaml_value(parameter['parameter_value']))
+        lines.append("    deploy_method: " + resource['deploy_method'])
+        lines.append("    deployment_targets:")
+        lines.append("      organizational_units:")
+        lines.extend("        - " + ou for ou in resource['deployment_targets']['organizational_units'])
+        lines.append("    regions:")
+        lines.extend("      - " + region for region in resource['regions'])
+    return "\n".join(lines) + "\n"
+
+
+def parameter_help(template):
+    return {p.name: p.help() for p in template['Parameters']}
+
+
+def render_yaml(template, verbose=False, **kwargs):
+    """
+    Render the manifest for a parsed template as yaml, with help comments when verbose is set
+    """
+    return render_document_yaml(manifest_document(template, **kwargs), [parameter_help(template)] if verbose else None)
+
+
+def render_manifest(template, verbose=False, fmt='yaml', **kwargs):
+    """
+    Render a parsed template as a manifest string in the yaml or json format. json has no comments, so verbose only
+    applies to yaml
+    """
+    if fmt == 'json':
+        return json.dumps(manifest_document(template, **kwargs), indent=2, default=str) + "\n"
+    if fmt == 'yaml':
+        return render_yaml(template, verbose, **kwargs)
+    raise ValueError("Unsupported manifest format %s, expected one of %s" % (fmt, ', '.join(FORMATS)))
+
+
+def write_manifest(manifest, out_path):
+    """
+    Write a rendered manifest in one go, creating the destination directory if needed
+    """
+    directory = os.path.dirname(out_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(out_path, 'w') as m:
+        m.write(manifest)
+
+
+class ManifestCache(object):
+    """
+    Remembers a key for each manifest written, a hash of the template content and the options it was generated with,
+    so a manifest whose key hasn't changed can be skipped. The keys are kept in a json file when path is given, and
+    in memory only otherwise. Template digests are reused for as long as the file's size and mtime don't change
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.errors = {}
+        self._stats = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    cached = json.load(f)
+                if cached.get('Version') == CACHE_VERSION:
+                    self.entries = cached['Manifests']
+            except (ValueError, KeyError, AttributeError):
+                self.entries = {}
+
+    def digest(self, template_path):
+        stat = os.stat(template_path)
+        cached = self._stats.get(template_path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return cached[1]
+        with open(template_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._stats[template_path] = ((stat.st_size, stat.st_mtime_ns), digest)
+        return digest
+
+    def key(self, digests, **options):
+        """
+        Key for a manifest generated from templates with the given digests and generator options
+        """
+        return hashlib.sha256(json.dumps([CACHE_VERSION, digests, options], sort_keys=True).encode()).hexdigest()
+
+    def fresh(self, out_path, key):
+        return self.entries.get(out_path) == key and os.path.exists(out_path)
+
+    def failures(self, out_path, key):
+        """
+        The failed results recorded for out_path with this key, so a watch doesn't retry and report them every poll
+        """
+        failed_key, failed = self.errors.get(out_path, (None, []))
+        return failed if failed_key == key else []
+
+    def record(self, out_path, key, written=True, failed=None):
+        """
+        Remember what came of generating out_path with key. A manifest written with failures, a combined one missing
+        some templates, only counts as fresh through the failures kept in memory, so the next run retries them
+        """
+        if written and not failed:
+            self.entries[out_path] = key
         else:
-            m.write("        parameter_value: \n")
-    m.write("    deploy_method: stack_set\n")
-    m.write("    deployment_targets:\n")
-    m.write("      organizational_units:\n")
-    m.write("        - [Enter your Organizational Unit]\n")
-    m.write("    regions:\n")
-    m.write("      - [The region where you wish to deploy this workload]\n")
+            self.entries.pop(out_path, None)
+        if failed:
+            self.errors[out_path] = (key, failed)
+        else:
+            self.errors.pop(out_path, None)
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'Version': CACHE_VERSION, 'Manifests': self.entries}, f, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def generate(path, out_path, verbose=False, fmt='yaml', cache=None):
+    """
+    Parse the template at path and write its manifest to out_path. With a ManifestCache the manifest is only written
+    when the template or the options changed since it was last generated. Returns whether it was written
+    """
+    key = cache.key([path, cache.digest(path)], verbose=verbose, fmt=fmt) if cache else None
+    if cache and cache.fresh(out_path, key):
+        return False
+    try:
+        write_manifest(render_manifest(parse_template(path), verbose, fmt), out_path)
+    except Exception:
+        if cache:
+            cache.record(out_path, key, written=False)
+        raise
+    if cache:
+        cache.record(out_path, key)
+    return True
+
+
+def template_stem(path):
+    name = os.path.basename(path)
+    for suffix in TEMPLATE_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def find_templates(inputs, exclude=()):
+    """
+    Expand template files, directories and glob patterns into a sorted list of template paths without duplicates.
+    Directories are searched recursively for files ending in one of TEMPLATE_SUFFIXES. Files and directories in
+    exclude are skipped, such as the output directory when it is below an input
+    """
+    excluded = [os.path.realpath(path) for path in exclude if path]
+
+    def is_excluded(path):
+        path = os.path.realpath(path)
+        return any(path == e or path.startswith(e.rstrip(os.sep) + os.sep) for e in excluded)
+
+    paths = set()
+    for pattern in inputs:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if is_excluded(match):
+                continue
+            if not os.path.isdir(match):
+                paths.add(os.path.normpath(match))
+                continue
+            for root, dirs, files in os.walk(match):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not is_excluded(os.path.join(root, d)))
+                paths.update(os.path.normpath(os.path.join(root, f)) for f in files
+                             if any(f.endswith(suffix) for suffix in TEMPLATE_SUFFIXES) and
+                             not is_excluded(os.path.join(root, f)))
+    return sorted(paths)
+
+
+def manifest_path(template_path, out_dir, fmt='yaml'):
+    """
+    Where the manifest of a template goes in batch mode, mirroring the template's location below out_dir
+    """
+    relative = os.path.relpath(template_path)
+    directory = os.path.dirname(relative) if not relative.startswith('..') else ''
+    return os.path.join(out_dir, directory, template_stem(template_path) + '.' + fmt)
+
+
+def _resource_file(template_path):
+    return os.path.relpath(template_path).replace(os.sep, '/')
+
+
+def process_template(template_path, out_path=None, verbose=False, fmt='yaml'):
+    """
+    Batch worker, runs in a pool process. Writes the manifest to out_path when given, otherwise returns the parsed
+    template so the parent can combine it. Errors are returned rather than raised so one bad template can't stop
+    the run
+    """
+    result = {'Path': template_path, 'OutPath': out_path, 'Template': None, 'Error': None, 'Skipped': False}
+    try:
+        template = parse_template(template_path)
+        if out_path:
+            write_manifest(render_manifest(template, verbose, fmt, name=template_stem(template_path),
+                                           resource_file=_resource_file(template_path)), out_path)
+        else:
+            result['Template'] = template
+    except YAMLError as e:
+        result['Error'] = str(e)
+    except Exception as e:
+        result['Error'] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def _process_template(args):
+    return process_template(*args)
+
+
+def render_combined(results, verbose=False, fmt='yaml'):
+    """
+    Render one manifest with a resource for each successfully parsed template in results. Resource names are the
+    template stems, made unique with a numeric suffix
+    """
+    resources = []
+    comments = []
+    names = set()
+    for result in results:
+        if result['Template'] is None:
+            continue
+        name = template_stem(result['Path'])
+        index = 2
+        while name in names:
+            name = "%s-%s" % (template_stem(result['Path']), index)
+            index += 1
+        names.add(name)
+        resources.append(manifest_resource(result['Template'], name=name,
+                                           resource_file=_resource_file(result['Path'])))
+        comments.append(parameter_help(result['Template']))
+    document = {'region': REGION_PLACEHOLDER, 'version': MANIFEST_VERSION, 'resources': resources}
+    if fmt == 'json':
+        return json.dumps(document, indent=2, default=str) + "\n"
+    return render_document_yaml(document, comments if verbose else None)
+
+
+def _digests(paths, cache):
+    digests = {}
+    for path in paths:
+        try:
+            digests[path] = cache.digest(path)
+        except OSError:
+            digests[path] = None
+    return digests
+
+
+def run_batch(inputs, out_dir='temp/manifests', combined=None, verbose=False, fmt=None, jobs=None, cache=None,
+              log=sys.stderr, quiet=False):
+    """
+    Generate manifests for every template found by find_templates(inputs) on a process pool. Writes one manifest per
+    template below out_dir, or a single manifest with a resource per template to combined, neither of which is read
+    as an input. With a ManifestCache, templates whose manifest is up to date are skipped, a combined manifest is
+    skipped when none of its templates changed. Failures are reported per file and summarised at the end, quiet leaves out the summary of a run in
+    which nothing was generated. Returns the list of process_template() results, skipped templates have Skipped set
+    """
+    # out_dir isn't written to when there is a combined manifest, templates below it are still inputs then
+    paths = find_templates(inputs, [combined or out_dir, cache.path if cache else None])
+    fmt = format_for(combined or '', fmt)
+    digests = _digests(paths, cache) if cache else {}
+    keys = {}
+    skipped = []
+    known = []
+    if combined:
+        tasks = [(path, None, verbose, fmt) for path in paths]
+        if cache:
+            keys[combined] = cache.key(sorted(digests.items()), verbose=verbose, fmt=fmt)
+            known = cache.failures(combined, keys[combined])
+            if paths and (known or cache.fresh(combined, keys[combined])):
+                skipped = [path for path in paths if path not in [result['Path'] for result in known]]
+                tasks = []
+    else:
+        tasks = []
+        for path in paths:
+            out_path = manifest_path(path, out_dir, fmt)
+            if cache:
+                keys[out_path] = cache.key([path, digests[path]], verbose=verbose, fmt=fmt, named=True)
+                if cache.fresh(out_path, keys[out_path]):
+                    skipped.append(path)
+                    continue
+                if cache.failures(out_path, keys[out_path]):
+                    known.extend(cache.failures(out_path, keys[out_path]))
+                    continue
+            tasks.append((path, out_path, verbose, fmt))
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(tasks) or 1))
+    if jobs == 1:
+        results = [_process_template(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_process_template, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+    failed = [result for result in results if result['Error']]
+    written = len(results) - len(failed)
+    if combined and results:
+        written = 0
+        if len(failed) < len(results):
+            write_manifest(render_combined(results, verbose, fmt), combined)
+            written = 1
+        if cache:
+            cache.record(combined, keys[combined], written, failed)
+    elif cache:
+        for result in results:
+            cache.record(result['OutPath'], keys[result['OutPath']], not result['Error'],
+                         [result] if result['Error'] else None)
+    if cache:
+        cache.save()
+    reported = failed if quiet else known + failed
+    for result in reported:
+        print("%s: %s" % (result['Path'], result['Error']), file=log)
+    if results or not quiet:
+        print("%s templates, %s manifests written, %s unchanged, %s failed"
+              % (len(paths), written, len(skipped), len(known) + len(failed)), file=log)
+    for result in reported:
+        print("  FAILED %s" % result['Path'], file=log)
+    return known + results + [{'Path': path, 'OutPath': None, 'Template': None, 'Error': None, 'Skipped': True}
+                      for path in skipped]
+
+
+def watch(step, interval=2.0, log=sys.stderr):
+    """
+    Call step() every interval seconds until interrupted. step regenerates whatever changed, a ManifestCache keeps
+    the polls cheap as unchanged templates are only stat'ed
+    """
+    print("Watching for template changes every %ss, press Ctrl-C to stop" % interval, file=log)
+    try:
+        while True:
+            step()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+# Sections read when walking nested stacks, and the sections searched for references to parameters
+GRAPH_SECTIONS = ['Parameters', 'Rules', 'Conditions', 'Resources', 'Outputs']
+# An S3 key prefix parameter in a TemplateURL, child template keys are relative to it
+KEY_PREFIX = re.compile(r'\$\{[A-Za-z0-9]*KeyPrefix\}')
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+
+def references(value):
+    """
+    Return the names referenced from a template fragment with Ref, Fn::GetAtt and ${Name} in Fn::Sub. GetAtt and
+    dotted Sub variables are returned as Resource.Attribute
+    """
+    refs = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'Ref' and isinstance(item, str):
+                refs.add(item)
+            elif key == 'Fn::GetAtt':
+                attribute = item.split('.', 1) if isinstance(item, str) else item
+                if isinstance(attribute, list) and all(isinstance(part, str) for part in attribute):
+                    refs.add('.'.join(attribute))
+                else:
+                    refs.update(references(item))
+            elif key == 'Fn::Sub':
+                text = item if isinstance(item, str) else item[0] if isinstance(item, list) and item else None
+                if isinstance(text, str):
+                    refs.update(SUB_VARIABLE.findall(text))
+                if isinstance(item, list):
+                    refs.update(references(item[1:]))
+            else:
+                refs.update(references(item))
+    elif isinstance(value, list):
+        for item in value:
+            refs.update(references(item))
+    return refs
+
+
+def _url_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict) and 'Fn::Sub' in value:
+        sub = value['Fn::Sub']
+        return sub if isinstance(sub, str) else sub[0] if isinstance(sub, list) and sub else None
+    if isinstance(value, dict) and 'Fn::Join' in value:
+        separator, parts = value['Fn::Join']
+        return separator.join(part if isinstance(part, str) else
+                              '${%s}' % part['Ref'] if isinstance(part, dict) and 'Ref' in part else '${?}'
+                              for part in parts)
+    return None
+
+
+def project_root(template_path):
+    """
+    The directory template keys are relative to: the parent of the nearest templates directory above the template,
+    which is the Quick Start or submodule root, or the template's own directory
+    """
+    directory = os.path.dirname(os.path.abspath(template_path))
+    while os.path.dirname(directory) != directory:
+        if os.path.basename(directory) == 'templates':
+            return os.path.dirname(directory)
+        directory = os.path.dirname(directory)
+    return os.path.dirname(os.path.abspath(template_path))
+
+
+def resolve_template_url(value, template_path):
+    """
+    Map a nested stack's TemplateURL to a local file. Keys after an S3 key prefix parameter, such as
+    ${QSS3KeyPrefix}submodules/quickstart-aws-vpc/templates/aws-vpc.template.yaml, and urls with a templates/ or
+    submodules/ path are taken relative to project_root(), plain relative paths relative to the template. Returns
+    None when the url can't be mapped
+    """
+    url = _url_string(value)
+    if url is None:
+        return None
+    match = KEY_PREFIX.search(url)
+    if match:
+        key = url[match.end():]
+    else:
+        starts = [url.find(prefix) for prefix in ['submodules/', 'templates/'] if prefix in url]
+        if starts:
+            key = url[min(starts):]
+        elif '://' not in url and '${' not in url:
+            return os.path.relpath(os.path.normpath(os.path.join(os.path.dirname(template_path), url)))
+        else:
+            return None
+    if '${' in key:
+        return None
+    return os.path.relpath(os.path.normpath(os.path.join(project_root(template_path), key)))
+
+
+class StackGraph(object):
+    """
+    Walks the nested stacks of templates and reports how parameters flow from each parent into its children. Every
+    template is loaded at most once per graph, so one graph shared by many entrypoints parses a common submodule
+    template only once
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._nodes = {}
+        self.loads = 0
+
+    def template(self, path):
+        """
+        Return (template, error) for path, error is 'not found' for a missing file, the submodules may not be
+        checked out
+        """
+        if path not in self._templates:
+            if not os.path.isfile(path):
+                self._templates[path] = (None, 'not found')
+            else:
+                self.loads += 1
+                try:
+                    cfn = load_template(path, GRAPH_SECTIONS)
+                    if not isinstance(cfn, dict):
+                        raise YAMLError("%s is not a CloudFormation template" % path)
+                    self._templates[path] = (cfn, None)
+                except YAMLError as e:
+                    self._templates[path] = (None, str(e))
+        return self._templates[path]
+
+    def node(self, path, _parents=()):
+        """
+        Return the report for the template at path as a dict: its Parameters, the Unused ones that nothing in the
+        template refers to, and a Children entry for each AWS::CloudFormation::Stack resource with the Parameters
+        passed to it and where their values come From
+        """
+        path = os.path.relpath(os.path.normpath(path))
+        if path in _parents:
+            return {'Path': path, 'Error': 'nested stack cycle'}
+        if path in self._nodes:
+            return self._nodes[path]
+        cfn, error = self.template(path)
+        if error:
+            return {'Path': path, 'Error': error}
+        parameters = cfn.get('Parameters') or {}
+        resources = cfn.get('Resources') or {}
+        stacks = {name for name, resource in resources.items()
+                  if isinstance(resource, dict) and resource.get('Type') == 'AWS::CloudFormation::Stack'}
+        used = set()
+        for section in GRAPH_SECTIONS[1:]:
+            used.update(name.split('.', 1)[0] for name in references(cfn.get(section)))
+        node = {
+            'Path': path,
+            'Parameters': sorted(parameters),
+            'Unused': sorted(name for name in parameters if name not in used),
+            'Children': []
+        }
+        for name in sorted(stacks):
+            properties = resources[name].get('Properties') or {}
+            child_path = resolve_template_url(properties.get('TemplateURL'), path)
+            child = self.node(child_path, _parents + (path,)) if child_path else \
+                {'Path': None, 'Error': 'unresolved TemplateURL'}
+            passed = {}
+            for key, value in sorted((properties.get('Parameters') or {}).items()):
+                refs = references(value)
+                passed[key] = {
+                    'From': sorted(ref for ref in refs if ref in parameters),
+                    'Outputs': sorted(ref for ref in refs if ref.split('.', 1)[0] in stacks),
+                    'Value': value if not isinstance(value, (dict, list)) else None
+                }
+            entry = {'Resource': name, 'Path': child_path, 'Parameters': passed, 'Stack': child}
+            if 'Error' not in child:
+                child_parameters = (self.template(child_path)[0].get('Parameters') or {})
+                entry['Missing'] = sorted(key for key, child_parameter in child_parameters.items()
+                                          if key not in passed and 'Default' not in (child_parameter or {}))
+                entry['Unknown'] = sorted(key for key in passed if key not in child_parameters)
+            node['Children'].append(entry)
+        self._nodes[path] = node
+        return node
+
+
+def render_stack_report(node, indent=0):
+    """
+    Render a StackGraph.node() report as indented text lines
+    """
+    pad = '  ' * indent
+    if 'Error' in node:
+        return []
+    lines = []
+    if node['Unused']:
+        lines.append(pad + "unused parameters: " + ', '.join(node['Unused']))
+    for child in node['Children']:
+        stack = child['Stack']
+        status = " (%s)" % stack['Error'] if 'Error' in stack else ''
+        lines.append("%s%s -> %s%s" % (pad, child['Resource'], child['Path'] or '?', status))
+        for key, passed in child['Parameters'].items():
+            sources = passed['From'] + passed['Outputs']
+            if sources:
+                lines.append("%s  %s <- %s" % (pad, key, ', '.join(sources)))
+            elif passed['Value'] is not None:
+                lines.append("%s  %s = %s" % (pad, key, passed['Value']))
+            else:
+                lines.append("%s  %s = <expression>" % (pad, key))
+        if child.get('Missing'):
+            lines.append("%s  not passed and no default: %s" % (pad, ', '.join(child['Missing'])))
+        if child.get('Unknown'):
+            lines.append("%s  not parameters of the child: %s" % (pad, ', '.join(child['Unknown'])))
+        lines.extend(render_stack_report(stack, indent + 1))
+    return lines
+
+
+def stack_report(paths, fmt='yaml', graph=None):
+    """
+    Build the nested stack report of each template in paths with one shared StackGraph, as text or json
+    """
+    graph = graph or StackGraph()
+    nodes = [graph.node(path) for path in paths]
+    if fmt == 'json':
+        return json.dumps(nodes, indent=2, default=str) + "\n"
+    lines = []
+    for node in nodes:
+        lines.append(node['Path'] + (" (%s)" % node['Error'] if 'Error' in node else ''))
+        lines.extend(render_stack_report(node, 1))
+    lines.append("%s templates parsed" % graph.loads)
+    return "\n".join(lines) + "\n"
+
+
+def format_for(out_path, fmt=None):
+    if fmt:
+        return fmt
+    return 'json' if out_path.lower().endswith('.json') else 'yaml'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Generate a Customizations for Control Tower manifest from a "
+                                                 "CloudFormation template")
+    parser.add_argument("path", nargs='?', default="templates/linux-bastion.template",
+                        help="Provide a path to the template file", type=str)
+    parser.add_argument("outPath", nargs='?', default="temp/py_manifest.yaml",
+                        help="Provide a destination path for the output file", type=str)
+    parser.add_argument("-v", "--verboseManifest", help="Include help comments in the manifest", action="store_true")
+    parser.add_argument("-f", "--format", choices=FORMATS,
+                        help="Manifest format, json when outPath ends in .json and yaml otherwise")
+    batch = parser.add_argument_group("batch mode", "Generate manifests for many templates, path and outPath are "
+                                                    "ignored when --batch is given")
+    batch.add_argument("-b", "--batch", action="append", metavar="PATTERN",
+                       help="A template, directory or glob such as 'submodules/*/templates', can be repeated")
+    batch.add_argument("-o", "--outDir", default="temp/manifests",
+                       help="Directory for the per template manifests, templates below it are not read as inputs "
+                            "(default: %(default)s)")
+    batch.add_argument("-c", "--combined", metavar="FILE",
+                       help="Write one manifest with a resource for each template instead")
+    batch.add_argument("-j", "--jobs", type=int, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="Skip manifests whose template and options haven't changed since they were written, "
+                             "using the content hashes kept in FILE")
+    parser.add_argument("-w", "--watch", nargs='?', type=float, const=2.0, metavar="SECONDS",
+                        help="Keep running and regenerate the manifests of templates that change, polling every "
+                             "SECONDS (default: 2)")
+    parser.add_argument("-n", "--nested", action="store_true",
+                        help="Instead of writing manifests, print how parameters are passed to nested stacks, "
+                             "resolving TemplateURLs to local template and submodule files")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.nested:
+        paths = find_templates(args.batch) if args.batch else [args.path]
+        print(stack_report(paths, args.format or 'yaml'), end='')
+        return 0
+    cache = ManifestCache(args.cache) if args.cache or args.watch else None
+    if args.batch:
+        def step():
+            return run_batch(args.batch, args.outDir, args.combined, args.verboseManifest, args.format, args.jobs,
+                             cache, quiet=bool(args.watch))
+    else:
+        def step():
+            try:
+                if generate(args.path, args.outPath, args.verboseManifest, format_for(args.outPath, args.format),
+                            cache) and args.watch:
+                    print("Wrote %s" % args.outPath, file=sys.stderr)
+            except YAMLError as exc:
+                print(exc)
+                return None
+            finally:
+                if cache:
+                    cache.save()
+            return True
+    if args.watch:
+        return watch(step, args.watch)
+    results = step()
+    if args.batch:
+        return 1 if not results or any(result['Error'] for result in results) else 0
+    return 0 if results else 1
 
 
-except YAMLError as exc:
-    print(exc)
+if __name__ == '__main__':
+    sys.exit(main())
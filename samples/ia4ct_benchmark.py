@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Compare the template parsers of ia4ct.py on parse time and peak memory:
+
+* full_load  - yaml.full_load with a catch-all constructor for the short form tags, as ia4ct.py used to parse
+* loader     - a full load with ia4ct.TemplateLoader
+* sections   - ia4ct.TemplateLoader loading only ia4ct.MANIFEST_SECTIONS, what manifest generation uses
+
+    python samples/ia4ct_benchmark.py templates 'submodules/*/templates' --repeat 20
+
+Peak memory is measured with tracemalloc, which only sees memory allocated through python, not libyaml's own buffers.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ia4ct  # noqa: E402
+
+
+class FullLoader(yaml.FullLoader):
+    pass
+
+
+FullLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+
+
+def parse_full_load(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=FullLoader)
+
+
+def parse_loader(path):
+    return ia4ct.load_template(path)
+
+
+def parse_sections(path):
+    return ia4ct.load_template(path, ia4ct.MANIFEST_SECTIONS)
+
+
+PARSERS = [('full_load', parse_full_load), ('loader', parse_loader), ('sections', parse_sections)]
+
+
+def measure(parse, path, repeat):
+    """
+    Return the median parse time in seconds and the peak traced memory in bytes of one parse
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(path)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        parse(path)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ia4ct.py template parsers")
+    parser.add_argument("inputs", nargs='*', default=['templates', 'submodules/*/templates'],
+                        help="Templates, directories or globs (default: %(default)s)")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="Timed parses per template (default: 10)")
+    args = parser.parse_args(argv)
+
+    paths = ia4ct.find_templates(args.inputs)
+    if not paths:
+        print("No templates found in %s" % ', '.join(args.inputs))
+        return 1
+    print("libyaml: %s" % ('yes' if getattr(yaml, '__with_libyaml__', False) else 'no'))
+    print("%-50s %8s" % ('template', 'size') + ''.join(" %12s %10s" % (name, 'peak') for name, _ in PARSERS))
+    totals = {name: [0.0, 0] for name, _ in PARSERS}
+    for path in paths:
+        row = "%-50s %7dK" % (path[-50:], os.path.getsize(path) // 1024)
+        for name, parse in PARSERS:
+            try:
+                seconds, peak = measure(parse, path, args.repeat)
+            except yaml.YAMLError:
+                row += " %12s %10s" % ('error', '-')
+                continue
+            totals[name][0] += seconds
+            totals[name][1] = max(totals[name][1], peak)
+            row += " %10.2fms %9dK" % (seconds * 1000, peak // 1024)
+        print(row)
+    print("%-59s" % 'total time / max peak' + ''.join(
+        " %10.2fms %9dK" % (totals[name][0] * 1000, totals[name][1] // 1024) for name, _ in PARSERS))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())